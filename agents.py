@@ -1,16 +1,10 @@
 import mesa_geo as mg
-from pyproj import Transformer
 import rasterio
 import shapely
 from shapely.geometry import Point, LineString, Polygon
-from road_network import RoadNetwork
-import networkx as nx
-import geopandas as gpd
 import math
-from traffic import GMModel, GMModelLegacy
-from geopandas import GeoDataFrame, GeoSeries
-import pandas as pd
-import dask_geopandas as dgpd
+from traffic import GMModelLegacy
+from profiler import phase
 import numpy as np
 
 class Resident(mg.GeoAgent):
@@ -23,8 +17,13 @@ class Resident(mg.GeoAgent):
         self.destination = ()  # Placeholder for a test shelter location
         self.shelters = self.model.agents_by_type[Shelter]
         self.path = LineString()
-        self.path_index = 0
+        self.path_index = 0  # Index of the path edge the agent is on
+        self.path_progress = 0  # Distance travelled along the path
+        self.route_edges = np.empty(0, dtype=np.int64)  # Road network edge ids of the path
+        self.route_cum = np.zeros(1)  # Cumulative distance at each vertex of the path
+        self.route_xy = np.empty((0, 2))  # Coordinates of the path vertices
         self.speed = 0  # Speed in m/s
+        self.next_speed = 0  # Speed chosen in step, applied in advance
         self.heading = 0  # Heading in degrees (north=0, east=90, south=180, west=270)
         self.viewshed = None
         self.mode = "drive"  # Travel mode
@@ -36,7 +35,7 @@ class Resident(mg.GeoAgent):
         self.choose_shelter()
 
         # Calculate the decision-making time using a Rayleigh distribution
-        self.decision_time = (np.random.rayleigh(self.model.Rsig) + self.model.Rtau) * 60
+        self.decision_time = (self.model.rng.rayleigh(self.model.Rsig) + self.model.Rtau) * 60
 
         # Initialize evacuation time (infinity until evacuation is complete)
         self.evacuation_time = np.inf
@@ -49,6 +48,18 @@ class Resident(mg.GeoAgent):
         # Calculate the initial viewshed based on the heading
         self.viewshed = self.calculate_viewshed(self.heading)
 
+    @property
+    def status(self):
+        return self._status
+
+    @status.setter
+    def status(self, status):
+        # Keep the status counters of the model up to date, the resident engine updates them itself
+        old_status = getattr(self, "_status", None)
+        self._status = status
+        if status != old_status and self.model.resident_engine is None:
+            self.model.update_status(self, old_status, status)
+
     def calculate_heading(self, from_point: Point, to_point: Point):
         """
         Calculate the heading from one point to another.
@@ -126,109 +137,162 @@ class Resident(mg.GeoAgent):
         
         return agents_in_viewshed
     
-    def get_nearest_agent(self, agents):
-        """
-        Get the nearest agent from a GeoDataFrame of agents using spatial index.
-        :param agents: A GeoDataFrame of agents.
-        :type agents: GeoDataFrame
-        :return: A GeoSeries containing the nearest agent.
-        :rtype: GeoSeries
-        """
-        
-        # Use spatial index to find the nearest agent
-        nearest_idx = agents.sindex.nearest(self.geometry, max_distance=100)[0,0]
-        
-        # Return the nearest agent as a GeoSeries
-        nearest_agent = agents.iloc[nearest_idx]
-        
-        return nearest_agent
-
     def choose_shelter(self):
-        # Choose the nearest shelter based on the shortest path
-        min_distance = float('inf')
-        nearest_shelter = None
-        nearest_shelter_path = None
-        for shelter in self.shelters:
-            path = self.model.road_network.get_shortest_path((self.geometry.x, self.geometry.y), (shelter.geometry.x, shelter.geometry.y))
-            distance = LineString(path).length
-            if distance < min_distance:
-                min_distance = distance
-                nearest_shelter = shelter
-                nearest_shelter_path = LineString(path)
-        self.destination = (nearest_shelter.geometry.x, nearest_shelter.geometry.y)
+        # Choose the nearest shelter based on the shortest path trees of the shelters
+        shelters = list(self.shelters)
+        shelter_index, path = self.model.road_network.get_nearest_shelter_path(
+            (self.geometry.x, self.geometry.y), [shelter.geometry for shelter in shelters]
+        )
+        if len(path) == 1:
+            # The resident snaps to the shelter node
+            path = path * 2
+        nearest_shelter = shelters[shelter_index] if shelter_index is not None else None
+        nearest_shelter_path = LineString(path)
+        self.destination = (nearest_shelter.geometry.x, nearest_shelter.geometry.y) if nearest_shelter else ()
         self.path = nearest_shelter_path
-        self.path_index = 0
+        self.route_edges, self.route_cum = self.model.road_network.get_route_arrays(path)
+        self.route_xy = np.asarray(path, dtype=float).reshape(-1, 2)
+        # Distance along the path of the home location, the only projection onto the path,
+        # the position is then tracked as a distance along the path
+        self.path_progress = self.path.project(self.geometry) if len(self.route_edges) > 0 else 0
+        self.path_index = self.locate_path_index(self.path_progress) if len(self.route_edges) > 0 else 0
         self.distance_to_dest = nearest_shelter_path.length
 
+    def set_route(self, path, progress, shelter=None):
+        """
+        Follow a new path from `progress` along it, such as a detour around the roads closed
+        by the fire, see FireRerouter.
+        :param path: The path as a list of network nodes.
+        :type path: list
+        :param progress: The distance along the path of the resident.
+        :type progress: float
+        :param shelter: The shelter at the end of the path.
+        :type shelter: Shelter
+        """
+
+        self.destination = (shelter.geometry.x, shelter.geometry.y) if shelter else ()
+        self.path = LineString(path)
+        self.route_edges, self.route_cum = self.model.road_network.get_route_arrays(path)
+        self.route_xy = np.asarray(path, dtype=float).reshape(-1, 2)
+        self.path_progress = progress
+        self.path_index = self.locate_path_index(progress)
+        self.distance_to_dest = self.route_cum[-1] - progress
+
+        # Move the registration on the road network to the new path
+        if self.model.road_network.is_registered(self.unique_id):
+            self.model.road_network.register_vehicle(
+                self, self.unique_id, self.route_edges[self.path_index], progress - self.route_cum[self.path_index]
+            )
+
+    def locate_path_index(self, progress):
+        """Get the index of the path edge at `progress` along the path."""
+        return min(max(int(np.searchsorted(self.route_cum, progress, side="right")) - 1, 0), len(self.route_edges) - 1)
+
+    def get_point_at(self, progress):
+        """
+        Get the point at `progress` along the path, by linear interpolation on the path edge
+        containing it. Positions before the start or past the end of the path are clamped.
+        :return: The (x, y) coordinates of the point, or None if the resident has no path.
+        :rtype: np.ndarray | None
+        """
+
+        if len(self.route_edges) == 0:
+            return None
+        i = self.locate_path_index(progress)
+        start, end = self.route_xy[i], self.route_xy[i + 1]
+        length = self.route_cum[i + 1] - self.route_cum[i]
+        t = min(max((progress - self.route_cum[i]) / length, 0.0), 1.0) if length > 0 else 0.0
+        return start + t * (end - start)
+
+    def get_leader(self):
+        """
+        Get the vehicle ahead on the road network, from the position of the agent along its path.
+        :return: The resident ahead, or None.
+        :rtype: Resident | None
+        """
+
+        if len(self.route_edges) == 0:
+            return None
+        return self.model.road_network.find_leader(
+            self.unique_id, self.route_edges, self.route_cum, self.locate_path_index(self.path_progress), self.path_progress
+        )
+
     def update_speed(self):
         """Update the speed using the sin wave between 0 - 25, every 10 steps"""
         self.speed = 1 * abs(math.sin(self.model.steps / 10))
 
     def step(self):
 
-        # Check if the agent is in the fire hazard area
-        if self.geometry.within(self.model.agents_by_type[FireHazard][0].geometry):
+        # Check if the fire has reached the raster cell of the agent
+        if self.model.fire_reached(self.geometry.x, self.geometry.y):
             self.status = "dead"
             return
         
         if self.model.time_elapsed < self.decision_time:
             self.status = "waiting"
 
+        elif len(self.route_edges) == 0:
+            # No shelter is reachable, the resident stays where it is
+            self.status = "stranded"
+
         elif (self.distance_to_dest >= 0) and (self.model.time_elapsed >= self.decision_time):
             self.status = "evacuating"
 
-            # Find the nearest agent in viewshed
-            # TODO: performance issue
-            # agents_in_viewshed = self.get_agents_in_viewshed(self.model.agents_by_type[Resident])
-            residents = self.model.agents_by_type[Resident].get(["unique_id", "status", "geometry"])
-            residents_df = pd.DataFrame(residents, columns=["unique_id","status", "geometry"])
-            residents_df = residents_df[residents_df["status"] == "evacuating"]
-            residents_gdf = GeoDataFrame(residents_df, geometry="geometry", crs=self.crs)
-            residents_sindex = residents_gdf.sindex
-            # viewshed_gdf = GeoDataFrame(geometry=[self.viewshed], crs=self.crs)
-            # Get the agents in the viewshed
-            # agents_in_viewshed = gpd.sjoin(residents_gdf, viewshed_gdf, predicate="within", how="inner")
-            agents_in_viewshed = residents_gdf.iloc[residents_sindex.intersection(self.viewshed.bounds)]
-            if agents_in_viewshed.shape[0] > 0:
-                nearest_agent = self.get_nearest_agent(agents_in_viewshed)
-                if nearest_agent.unique_id == self.unique_id:
-                    nearest_agent = None
-                else:
-                    # Convert nearest_agent to Resident type, there is a bug here TODO
-                    nearest_agent = self.model.agents_by_type[Resident][nearest_agent.unique_id - 4]
-                    # nearest_agent = next(agent for agent in self.model.agents_by_type[Resident] if agent.unique_id == nearest_agent.unique_id)
-            else:
-                nearest_agent = None
-
-            # Update speed using car following model
-            gm_model = GMModelLegacy(self.model, nearest_agent, self)
-            self.speed = gm_model.update_speed()
-
-            # Calculate the distance to travel in this step (speed in km/h, step_interval in seconds)
-            distance_to_travel = self.speed * self.model.step_interval  # convert speed to m/s
-            
-            # Calculate the next point based on the distance to travel
-            current_point = self.geometry
-            next_point = self.path.interpolate(self.path.project(current_point) + distance_to_travel)
-            if next_point is None:
-                # TODO, minor bug here. For some reason, we can't get the next point.
-                next_point = current_point
-            
-            # Update the geomety
-            self.geometry = Point(next_point.x, next_point.y)
-
-            # Update the heading
-            self.heading = self.calculate_heading(current_point, next_point)
-            self.viewshed = self.calculate_viewshed(self.heading)
-
-            # Update the distance to destination
-            self.distance_to_dest -= distance_to_travel
+            # Find the vehicle ahead on the road network
+            with phase(self.model.profiler, "leader"):
+                nearest_agent = self.get_leader()
+
+            # Update speed using car following model, applied in advance()
+            with phase(self.model.profiler, "car_following"):
+                gm_model = GMModelLegacy(self.model, nearest_agent, self)
+                self.next_speed = gm_model.update_speed()
         else:
             self.status = "evacuated"
             if self.evacuation_time > self.model.time_elapsed:
                 self.evacuation_time = self.model.time_elapsed / 60
                 self.model.evacuation_time_list.append(self.evacuation_time)
 
+    def advance(self):
+        """
+        Move along the path with the speed chosen in `step`, right after it with sequential
+        updates, or once every resident has chosen its speed with simultaneous updates.
+        """
+
+        if self.status != "evacuating":
+            self.model.road_network.unregister_vehicle(self.unique_id)
+            return
+
+        self.speed = self.next_speed
+
+        # Calculate the distance to travel in this step (speed in km/h, step_interval in seconds)
+        distance_to_travel = self.speed * self.model.step_interval  # convert speed to m/s
+        
+        # Calculate the next point based on the distance to travel
+        current_point = self.geometry
+        self.path_progress += distance_to_travel
+        with phase(self.model.profiler, "move"):
+            next_xy = self.get_point_at(self.path_progress)
+        # Residents without a path (no route found) stay where they are
+        next_point = Point(next_xy) if next_xy is not None else current_point
+        
+        # Update the geomety
+        self.geometry = Point(next_point.x, next_point.y)
+
+        # Update the heading
+        self.heading = self.calculate_heading(current_point, next_point)
+
+        # Register on the road network edge the agent is now on
+        if len(self.route_edges) > 0:
+            with phase(self.model.profiler, "register"):
+                self.path_index = self.locate_path_index(self.path_progress)
+                self.model.road_network.register_vehicle(
+                    self, self.unique_id, self.route_edges[self.path_index],
+                    self.path_progress - self.route_cum[self.path_index]
+                )
+
+        # Update the distance to destination
+        self.distance_to_dest -= distance_to_travel
+
 class Shelter(mg.GeoAgent):
 
     def __init__(self, model, geometry, crs):
@@ -239,12 +303,25 @@ class FireHazard(mg.GeoAgent):
     def __init__(self, model, geometry, crs):
         super().__init__(model, geometry, crs)
 
-    def step(self):
+    @property
+    def geometry(self):
+        # The burnt area is only polygonized when the geometry is read, at most once per step
+        if self._geometry_step != self.model.steps:
+            with phase(self.model.profiler, "polygonize"):
+                self._geometry = self.get_burnt_area()
+            self._geometry_step = self.model.steps
+        return self._geometry
+
+    @geometry.setter
+    def geometry(self, geometry):
+        self._geometry = geometry
+        self._geometry_step = self.model.steps
 
+    def get_burnt_area(self):
         # Get the fire hazard cells
         hazard_cell = self.model.space.layers[0].get_raster(attr_name="is_burnt")
         # Update the geometry using the hazard cell
         mask = hazard_cell == True
         hazard_shapes = list(rasterio.features.shapes(hazard_cell, mask=mask, transform=self.model.transform))
         hazard_geoms = [shapely.geometry.shape(geom) for geom, value in hazard_shapes if value >= 0]
-        self.geometry = shapely.ops.unary_union(hazard_geoms)
+        return shapely.ops.unary_union(hazard_geoms)
@@ -1,14 +1,20 @@
+import asyncio
+import time
 import numpy as np
 import matplotlib.colors as mcolors
 import matplotlib.pyplot as plt
 from matplotlib.figure import Figure
-from mesa.visualization import Slider, SolaraViz, make_plot_component
-from mesa_geo.visualization import make_geospace_component
-from mesa.visualization.utils import update_counter
+from mesa.visualization import Slider, make_plot_component
+from mesa.visualization.solara_viz import ComponentsView, ModelCreator, ShowSteps
+from mesa.visualization.utils import force_update, update_counter
+from mesa_geo.tile_layers import RasterWebTile
 import mesa_geo as mg
 from model import EvacuationModel
+from road_network import setup_logging
 from agents import Resident, Shelter, FireHazard
-from cell import FireHazardCell
+from cell import FireHazardCell, FireHazardLayer
+from folium.utilities import image_to_url
+import ipyleaflet
 import xyzservices.providers as xyz
 import solara
 
@@ -45,6 +51,16 @@ model_params = {
         "value": 1.65,
         "label": "Scale Factor Parameter",
     },
+    "fast_forward": {
+        "type": "Checkbox",
+        "value": False,
+        "label": "Fast Forward",
+    },
+    "reroute": {
+        "type": "Checkbox",
+        "value": False,
+        "label": "Reroute Around Fire",
+    },
 }
 
 def draw_agents(agent):
@@ -76,6 +92,11 @@ def draw_agents(agent):
                 "color": "#000000",  # Black
                 "weight": 2,
                 }
+            if agent.status == "stranded":
+                return {
+                "color": "#808080",  # Gray
+                "weight": 2,
+                }
         elif isinstance(agent, Shelter):
             return {
                 "color": "Red",
@@ -121,7 +142,7 @@ def map_to_red_gradient(cell_values, min_value=0, max_value=120):
 
 def display_txt(model):
     minutes, seconds = divmod(model.time_elapsed, 60)
-    return solara.Markdown(f"**Time Elapsed:** {int(minutes):02d}:{int(seconds):02d} <br >**Evacuated:** {model.n_evacuated} **Casuality:** {model.n_dead} <br> **Percentage of Evacuated:** {model.n_evacuated / model.num_residents:.2%} <br> **Percentage of Casuality:** {model.n_dead / model.num_residents:.2%}")
+    return solara.Markdown(f"**Time Elapsed:** {int(minutes):02d}:{int(seconds):02d} <br >**Evacuated:** {model.n_evacuated} **Casuality:** {model.n_dead} **Stranded:** {model.n_stranded} <br> **Percentage of Evacuated:** {model.n_evacuated / model.num_residents:.2%} <br> **Percentage of Casuality:** {model.n_dead / model.num_residents:.2%}")
 
 def post_process_line_plot(ax):
     """
@@ -139,38 +160,71 @@ def post_process_line_plot(ax):
     ax.spines["right"].set_visible(False)
     ax.spines["top"].set_visible(False)
 
+class EvacuationTimeHistogram:
+    """
+    Counts of the evacuation times in fixed width bins. Each update only counts the
+    residents evacuated since the last one, the model's evacuation_time_list only grows.
+    The mean and the median are exact, the median is taken from the evacuation times
+    themselves rather than from the bins.
+    """
+
+    def __init__(self, bin_width=1.0):
+        self.bin_width = bin_width  # in minutes
+        self.counts = np.zeros(0, dtype=np.int64)
+        self.n = 0  # number of evacuation times counted
+        self.total = 0.0  # their sum
+        self.times = []  # the evacuation times, the list of the model
+
+    def update(self, evacuation_time_list):
+        self.times = evacuation_time_list
+        times = np.asarray(evacuation_time_list[self.n:], dtype=float)
+        if times.size == 0:
+            return
+        bins = np.bincount(np.floor(times / self.bin_width).astype(np.int64))
+        if len(bins) > len(self.counts):
+            self.counts = np.pad(self.counts, (0, len(bins) - len(self.counts)))
+        self.counts[:len(bins)] += bins
+        self.n += times.size
+        self.total += times.sum()
+
+    def mean(self):
+        return self.total / self.n
+
+    def median(self):
+        return float(np.median(self.times[:self.n]))
+
 @solara.component
 def evacuation_time_plot(model):
     update_counter.get()
-    fig = Figure()
+    # The histogram and the figure of the model, kept between renders
+    histogram = solara.use_memo(EvacuationTimeHistogram, dependencies=[model])
+    fig = solara.use_memo(Figure, dependencies=[model])
+    histogram.update(model.evacuation_time_list)
+    fig.clear()
     ax = fig.subplots()
 
     # Create histogram if evacuation_time_list is not empty
-    if np.sum(model.evacuation_time_list) > 0:
-        counts, bins, _ = ax.hist(
-            model.evacuation_time_list,
-            bins=20,
-            color="skyblue",
-            edgecolor="black"
-        )
+    if histogram.n > 0:
+        bins = np.arange(len(histogram.counts)) * histogram.bin_width
+        ax.bar(bins, histogram.counts, width=histogram.bin_width, align="edge", color="skyblue", edgecolor="black")
 
-        # Annotate histogram bars with counts
-        for count, bin_left, bin_right in zip(counts, bins[:-1], bins[1:]):
-            if count > 0:
-                bin_center = (bin_left + bin_right) / 2
-                ax.text(
-                    bin_center,
-                    count / 2,
-                    f"{int(count)}",
-                    ha="center",
-                    va="center",
-                    fontsize=8,
-                    bbox=dict(facecolor='none', edgecolor='none', alpha=0.7)
-                )
+        # Annotate histogram bars with counts, while they are wide enough
+        if len(bins) <= 30:
+            for count, bin_left in zip(histogram.counts, bins):
+                if count > 0:
+                    ax.text(
+                        bin_left + histogram.bin_width / 2,
+                        count / 2,
+                        f"{int(count)}",
+                        ha="center",
+                        va="center",
+                        fontsize=8,
+                        bbox=dict(facecolor='none', edgecolor='none', alpha=0.7)
+                    )
 
         # Add mean and median lines with labels
-        mean_value = np.mean(model.evacuation_time_list)
-        median_value = np.median(model.evacuation_time_list)
+        mean_value = histogram.mean()
+        median_value = histogram.median()
         ax.axvline(x=mean_value, color="red", linestyle="--", label="Mean")
         ax.axvline(x=median_value, color="green", linestyle="--", label="Median")
         ax.text(
@@ -217,18 +271,205 @@ def evacuation_status_plot(model):
     ax.set_ylabel("Number of Agents")
     solara.FigureMatplotlib(fig)
 
+class MapView:
+    """
+    The leaflet map of a model, made of widgets created once and updated in place:
+    on each frame only the residents whose position or style changed are sent to the
+    browser, and the fire image only when cells ignited.
+    """
+
+    def __init__(self, model, portrayal_method, tiles, zoom=13, radius=5):
+        self.model = model
+        self.portrayal_method = portrayal_method
+        self.radius = radius
+        self.residents = list(model.agents_by_type[Resident])
+        self.shelters = list(model.agents_by_type[Shelter])
+
+        lat, lon = self.get_locations(self.residents + self.shelters)
+        min_x, min_y, max_x, max_y = model.space.total_bounds
+        center_lon, center_lat = model.space.transformer.transform((min_x + max_x) / 2, (min_y + max_y) / 2)
+        self.map = ipyleaflet.Map(
+            basemap=ipyleaflet.TileLayer(url=RasterWebTile.from_xyzservices(tiles).to_dict()["url"]),
+            center=(center_lat, center_lon),
+            zoom=zoom,
+            scroll_wheel_zoom=True,
+        )
+        self.fire_image = None
+        self.fire_overlay = None
+
+        # One circle per agent, as drawn by mesa-geo
+        self.styles = [portrayal_method(agent) for agent in self.residents]
+        self.markers = [
+            ipyleaflet.Circle(location=(lat[i], lon[i]), radius=radius, **style) for i, style in enumerate(self.styles)
+        ]
+        self.lat = lat[:len(self.residents)]
+        self.lon = lon[:len(self.residents)]
+        n = len(self.residents)
+        self.map.add(ipyleaflet.LayerGroup(layers=[
+            ipyleaflet.Circle(location=(lat[n + i], lon[n + i]), radius=radius, **portrayal_method(agent))
+            for i, agent in enumerate(self.shelters)
+        ]))
+        self.map.add(ipyleaflet.LayerGroup(layers=self.markers))
+        self.update()
+
+    def get_locations(self, agents):
+        # The latitudes and longitudes of the agents
+        x = np.array([agent.geometry.x for agent in agents])
+        y = np.array([agent.geometry.y for agent in agents])
+        lon, lat = self.model.space.transformer.transform(x, y)
+        return np.asarray(lat, dtype=float).tolist(), np.asarray(lon, dtype=float).tolist()
+
+    def update(self):
+        # Redraw the fire when its image changed, it only does when cells ignited
+        image = self.model.fire_hazard_layer.to_image(self.portrayal_method)
+        if image is not self.fire_image:
+            self.fire_image = image
+            image = image.to_crs("epsg:4326")
+            url = image_to_url(image.values.transpose([1, 2, 0]))
+            bounds = ((image.total_bounds[1], image.total_bounds[0]), (image.total_bounds[3], image.total_bounds[2]))
+            if self.fire_overlay is None:
+                self.fire_overlay = ipyleaflet.ImageOverlay(url=url, bounds=bounds)
+                self.map.add(self.fire_overlay)
+            else:
+                self.fire_overlay.url = url
+
+        # Move and restyle the residents that changed
+        lat, lon = self.get_locations(self.residents)
+        for i, agent in enumerate(self.residents):
+            style = self.portrayal_method(agent)
+            moved = lat[i] != self.lat[i] or lon[i] != self.lon[i]
+            if not moved and style == self.styles[i]:
+                continue
+            marker = self.markers[i]
+            with marker.hold_sync():
+                if moved:
+                    marker.location = (lat[i], lon[i])
+                for key, value in style.items():
+                    setattr(marker, key, value)
+            self.styles[i] = style
+        self.lat = lat
+        self.lon = lon
+
+@solara.component
+def evacuation_map(model):
+    update_counter.get()
+    view = solara.use_memo(lambda: MapView(model, draw_agents, esri_imagery), dependencies=[model])
+    view.update()
+    solara.display(view.map)
+
+def run_frame(model, max_steps, max_seconds):
+    """
+    Step the model until the next frame is due, after max_steps steps or max_seconds
+    seconds, whichever comes first, or until it stops.
+    """
+
+    start = time.perf_counter()
+    for _ in range(max_steps):
+        if not model.running:
+            break
+        model.step()
+        if time.perf_counter() - start >= max_seconds:
+            break
+
+@solara.component
+def FrameController(model, *, model_parameters, frame_steps, frame_interval):
+    """
+    Model controls (reset, play, step) that step the model in a worker thread while it
+    plays, and only publish a frame to the components every `frame_steps` steps or
+    `frame_interval` milliseconds. The components render between the batches of steps,
+    so they never see a model being stepped.
+    """
+
+    playing = solara.use_reactive(False)
+    running = solara.use_reactive(True)
+    model_parameters = solara.use_reactive(model_parameters)
+
+    async def play():
+        while playing.value and running.value:
+            await asyncio.to_thread(run_frame, model.value, frame_steps.value, frame_interval.value / 1000)
+            running.value = model.value.running
+            force_update()
+            await asyncio.sleep(0)
+
+    solara.lab.use_task(play, dependencies=[playing.value, running.value], prefer_threaded=False)
+
+    def do_step():
+        model.value.step()
+        running.value = model.value.running
+        force_update()
+
+    def do_reset():
+        playing.value = False
+        running.value = True
+        model.value = model.value.__class__(**model_parameters.value)
+
+    def do_play_pause():
+        playing.value = not playing.value
+
+    with solara.Row(justify="space-between"):
+        solara.Button(label="Reset", color="primary", on_click=do_reset)
+        solara.Button(
+            label="▶" if not playing.value else "❚❚",
+            color="primary",
+            on_click=do_play_pause,
+            disabled=not running.value,
+        )
+        solara.Button(
+            label="Step",
+            color="primary",
+            on_click=do_step,
+            disabled=playing.value or not running.value,
+        )
+
+@solara.component
+def EvacuationViz(model, components, model_params, name, frame_steps=10, frame_interval=200):
+    """
+    The page of the app, as mesa's SolaraViz but with the FrameController.
+
+    Args:
+        model (EvacuationModel): The initial model.
+        components (list): The components, functions of the model.
+        model_params (dict): The user adjustable model parameters.
+        name (str): The title of the page.
+        frame_steps (int): The maximum number of steps between frames while playing.
+        frame_interval (int): The maximum time between frames while playing, in milliseconds.
+    """
+
+    model = solara.use_reactive(model)
+    model_parameters = solara.use_reactive({})
+    frame_steps = solara.use_reactive(frame_steps)
+    frame_interval = solara.use_reactive(frame_interval)
+
+    with solara.AppBar():
+        solara.AppBarTitle(name)
+
+    with solara.Sidebar(), solara.Column():
+        with solara.Card("Controls"):
+            solara.SliderInt(label="Steps per Frame", value=frame_steps, min=1, max=600)
+            solara.SliderInt(label="Frame Interval (ms)", value=frame_interval, min=50, max=2000, step=50)
+            FrameController(
+                model, model_parameters=model_parameters, frame_steps=frame_steps, frame_interval=frame_interval
+            )
+        with solara.Card("Model Parameters"):
+            ModelCreator(model, model_params, model_parameters=model_parameters)
+        with solara.Card("Information"):
+            ShowSteps(model.value)
+
+    ComponentsView(components, model.value)
+
+# Draw the fire as one image, colored through the colors of map_to_red_gradient instead of
+# calling draw_agents for every cell
+FireHazardLayer.color_lut = plt.cm.autumn_r(np.arange(plt.cm.autumn_r.N))
+FireHazardLayer.color_range = (0, 120)
+
+setup_logging()
 model = EvacuationModel()
 esri_imagery = xyz.USGS.USImagery
-page = SolaraViz(
+page = EvacuationViz(
     model,
     [   
         display_txt,
-        make_geospace_component(
-            draw_agents,
-            zoom=13,
-            tiles=esri_imagery,
-            # layout=Layout(width="800px"),
-        ),
+        evacuation_map,
         #make_plot_component("agents evacuated"), 
         make_plot_component({"Percentage of Evacuated": "tab:blue", "Percentage of Casuality": "tab:red"}, post_process=post_process_line_plot),
         evacuation_time_plot,
@@ -238,4 +479,4 @@ page = SolaraViz(
     model_params=model_params,
 )
 
-page
\ No newline at end of file
+page
@@ -0,0 +1,183 @@
+import csv
+import itertools
+import json
+import logging
+import multiprocessing
+import os
+import time
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from model import EvacuationModel
+
+logger = logging.getLogger(__name__)
+
+# Model arguments describing the input data and the road network, a worker run
+# only reads the data and the network cache prepared for them
+DATA_PARAMS = (
+    "network_backend", "population_distribution_shp", "shelters_shp", "road_network_shp", "hazard_raster", "crs", "cache_dir"
+)
+
+# Model arguments that only say where the files of a run are kept, not what is run
+INFRA_PARAMS = ("cache_dir",)
+
+# The columns of a results row after the run id and the parameters, see get_results_row
+RESULT_COLUMNS = ("steps", "n_evacuated", "n_dead", "n_stranded", "evacuation_time", "runtime")
+
+def scenario_grid(scenarios, **base_params):
+    """
+    Expand a dictionary of parameter values into one scenario per combination.
+    :param scenarios: The values of each EvacuationModel parameter.
+    :type scenarios: dict[str, list]
+    :param base_params: Parameters shared by all the scenarios.
+    :return: The EvacuationModel parameters of each scenario.
+    :rtype: list[dict]
+    """
+
+    names = list(scenarios)
+    return [dict(base_params, **dict(zip(names, values))) for values in itertools.product(*scenarios.values())]
+
+def get_run_id(params):
+    # Stable identifier of a run, used to skip the runs already in the results file, the
+    # infrastructure parameters are left out so a moved cache does not run everything again
+    return json.dumps({name: value for name, value in params.items() if name not in INFRA_PARAMS}, sort_keys=True)
+
+def prepare(scenarios):
+    """
+    Read the input data and build the road network cache (graph and shelter routing
+    table) once per distinct data configuration, before the workers start. Forked
+    workers inherit the loaded data, and every worker memory maps the same read-only
+    network cache instead of building it.
+    """
+
+    prepared = set()
+    for params in scenarios:
+        data_params = {name: params[name] for name in DATA_PARAMS if name in params}
+        key = json.dumps(data_params, sort_keys=True)
+        if key not in prepared:
+            EvacuationModel(num_residents=0, **data_params)
+            prepared.add(key)
+
+def process_pool(max_workers=None):
+    # mesa-geo sets the spawn start method on import, fork explicitly so the workers inherit the loaded data
+    context = multiprocessing.get_context("fork" if "fork" in multiprocessing.get_all_start_methods() else None)
+    return ProcessPoolExecutor(max_workers=max_workers or os.cpu_count(), mp_context=context)
+
+def run_scenario(params, max_steps=None):
+    """
+    Run one scenario until every resident is evacuated or dead, or for max_steps.
+    :param params: The EvacuationModel parameters.
+    :type params: dict
+    :param max_steps: The maximum number of steps, unbounded if None.
+    :type max_steps: int
+    :return: The results row of the run.
+    :rtype: dict
+    """
+
+    start = time.perf_counter()
+    model = EvacuationModel(**params)
+    model.max_steps = max_steps
+    while model.running and (max_steps is None or model.steps < max_steps):
+        model.step()
+    return get_results_row(params, model, time.perf_counter() - start)
+
+def get_results_row(params, model, runtime):
+    # The results row of a finished run
+    return {
+        "run_id": get_run_id(params),
+        **params,
+        "steps": model.steps,
+        "n_evacuated": int(model.n_evacuated),
+        "n_dead": int(model.n_dead),
+        "n_stranded": int(model.n_stranded),
+        "evacuation_time": json.dumps(model.evacuation_time_list),
+        "runtime": round(runtime, 3),
+    }
+
+def get_fieldnames(scenarios):
+    # The columns of the results rows of the scenarios: the run id, every parameter set by
+    # some scenario (in the order they first appear) and the results
+    names = {}
+    for params in scenarios:
+        names.update(dict.fromkeys(params))
+    return ["run_id", *names, *RESULT_COLUMNS]
+
+def get_results_writer(f, results_file, fieldnames):
+    """
+    Get a CSV writer appending rows to a results file, opened in append mode as f. A new
+    file gets the header, an existing one keeps its own, which must have every column.
+    Rows without some parameters leave their columns empty.
+    :param f: The results file, opened for appending.
+    :param results_file: The path of the results file.
+    :type results_file: str
+    :param fieldnames: The columns of the rows to write, see get_fieldnames.
+    :type fieldnames: list[str]
+    :return: The writer.
+    :rtype: csv.DictWriter
+    """
+
+    if f.tell() == 0:
+        writer = csv.DictWriter(f, fieldnames=fieldnames, restval="")
+        writer.writeheader()
+        return writer
+    with open(results_file, newline="") as existing:
+        header = next(csv.reader(existing), [])
+    missing = [name for name in fieldnames if name not in header]
+    if missing:
+        raise ValueError(
+            f"The results file {results_file} has no {', '.join(missing)} columns, write the results to a new file"
+        )
+    return csv.DictWriter(f, fieldnames=header, restval="")
+
+def load_finished(results_file):
+    # The run ids of the complete rows of a results file
+    if not os.path.exists(results_file):
+        return set()
+    with open(results_file, newline="") as f:
+        return {row["run_id"] for row in csv.DictReader(f) if None not in row.values()}
+
+def run_batch(scenarios, results_file="simulation_results.csv", max_workers=None, max_steps=None):
+    """
+    Run scenarios in parallel over a process pool, appending one row to the results
+    file as each run finishes. Runs already in the results file are skipped, so an
+    interrupted batch resumes where it stopped. A run that fails is logged and left out
+    of the results file, so it runs again when the batch is resumed.
+    :param scenarios: The EvacuationModel parameters of each run, see scenario_grid.
+    :type scenarios: list[dict]
+    :param results_file: The CSV file the results are appended to.
+    :type results_file: str
+    :param max_workers: The number of worker processes, all the cores if None.
+    :type max_workers: int
+    :param max_steps: The maximum number of steps of each run, unbounded if None.
+    :type max_steps: int
+    :return: The number of runs done, without the failed ones.
+    :rtype: int
+    """
+
+    finished = load_finished(results_file)
+    pending = [params for params in scenarios if get_run_id(params) not in finished]
+    print(f"{len(scenarios) - len(pending)} runs already done, {len(pending)} to run")
+    if not pending:
+        return 0
+
+    # The columns are fixed before any run, scenarios may set different parameters
+    fieldnames = get_fieldnames(scenarios)
+    with open(results_file, "a", newline="") as f:
+        writer = get_results_writer(f, results_file, fieldnames)
+        f.flush()  # before forking the workers
+        prepare(pending)
+        n_done = 0
+        with process_pool(max_workers) as executor:
+            futures = {executor.submit(run_scenario, params, max_steps): params for params in pending}
+            for finished_runs, future in enumerate(as_completed(futures), start=1):
+                try:
+                    row = future.result()
+                except Exception:
+                    logger.exception(f"Run {finished_runs}/{len(pending)} failed: {get_run_id(futures[future])}")
+                    continue
+                writer.writerow(row)
+                f.flush()
+                n_done += 1
+                print(f"Run {finished_runs}/{len(pending)} completed: {row['run_id']}, {row['steps']} steps, {row['runtime']} s")
+    return n_done
+
+if __name__ == "__main__":
+    run_batch(scenario_grid({"num_residents": [500, 600, 700, 800, 900], "Rtau": [90]}))
@@ -0,0 +1,305 @@
+import argparse
+import datetime
+import json
+import os
+import platform
+import subprocess
+import sys
+import tempfile
+import time
+import numpy as np
+import geopandas as gpd
+import rasterio as rio
+from rasterio.transform import from_origin
+from shapely.geometry import LineString, Point
+from model import EvacuationModel
+from road_network import RoadNetwork, SparseRoadNetwork
+from data_loader import read_vector
+
+NETWORK_BACKENDS = {"networkx": RoadNetwork, "sparse": SparseRoadNetwork}
+
+def make_grid_dataset(directory, grid_size=30, spacing=100, cell_size=30, n_population=10000, n_shelters=3,
+                      spread_rate=10, crs="EPSG:32611", seed=0):
+    """
+    Generate a synthetic dataset: a square grid road network, residents scattered over
+    it, shelters along its far edge and a fire spreading from the opposite corner.
+    :param directory: The directory the files are written to.
+    :type directory: str
+    :param grid_size: The number of road intersections along each side of the grid.
+    :type grid_size: int
+    :param spacing: The length of a road segment in meters.
+    :type spacing: float
+    :param cell_size: The size of a fire raster cell in meters.
+    :type cell_size: float
+    :param n_population: The number of resident locations.
+    :type n_population: int
+    :param n_shelters: The number of shelters.
+    :type n_shelters: int
+    :param spread_rate: The fire spread rate in meters per minute.
+    :type spread_rate: float
+    :param seed: The seed of the resident locations.
+    :type seed: int
+    :return: The EvacuationModel data parameters of the dataset.
+    :rtype: dict
+    """
+
+    os.makedirs(directory, exist_ok=True)
+    x0, y0 = 500000.0, 4000000.0
+    extent = (grid_size - 1) * spacing
+
+    # Road segments between neighbouring intersections
+    roads = []
+    for i in range(grid_size):
+        for j in range(grid_size - 1):
+            roads.append(LineString([(x0 + j * spacing, y0 + i * spacing), (x0 + (j + 1) * spacing, y0 + i * spacing)]))
+            roads.append(LineString([(x0 + i * spacing, y0 + j * spacing), (x0 + i * spacing, y0 + (j + 1) * spacing)]))
+
+    rng = np.random.default_rng(seed)
+    population = [Point(xy) for xy in rng.uniform((x0, y0), (x0 + extent, y0 + extent), size=(n_population, 2))]
+    shelter_x = np.linspace(x0, x0 + extent, n_shelters + 2)[1:-1]
+    shelters = [Point(x, y0 + extent) for x in shelter_x]
+
+    params = {
+        "road_network_shp": os.path.join(directory, "road_network.shp"),
+        "population_distribution_shp": os.path.join(directory, "population_distribution.shp"),
+        "shelters_shp": os.path.join(directory, "shelters.shp"),
+        "hazard_raster": os.path.join(directory, "fire_arrival_time.tif"),
+        "crs": crs,
+    }
+    gpd.GeoDataFrame(geometry=roads, crs=crs).to_file(params["road_network_shp"])
+    gpd.GeoDataFrame(geometry=population, crs=crs).to_file(params["population_distribution_shp"])
+    gpd.GeoDataFrame({"Id": range(n_shelters)}, geometry=shelters, crs=crs).to_file(params["shelters_shp"])
+
+    # Fire arrival time in minutes, spreading radially from the corner opposite to the shelters
+    n_cells = int(np.ceil(extent / cell_size)) + 1
+    centers = (np.arange(n_cells) + 0.5) * cell_size
+    arrival = np.hypot(centers[np.newaxis, :], centers[::-1, np.newaxis]) / spread_rate
+    with rio.open(
+        params["hazard_raster"], "w", driver="GTiff", width=n_cells, height=n_cells, count=1, dtype="float32",
+        crs=crs, transform=from_origin(x0, y0 + n_cells * cell_size, cell_size, cell_size), nodata=-9999,
+    ) as dst:
+        dst.write(arrival.astype(np.float32), 1)
+    return params
+
+def time_calls(func, repeat):
+    # Wall time in seconds of each of `repeat` calls to func
+    times = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        func()
+        times.append(time.perf_counter() - start)
+    return times
+
+def summarize(times):
+    times = np.asarray(times, dtype=float)
+    return {
+        "n": len(times),
+        "min": float(times.min()),
+        "median": float(np.median(times)),
+        "mean": float(times.mean()),
+        "p95": float(np.percentile(times, 95)),
+        "max": float(times.max()),
+    }
+
+def bench_network(data_params, backend, repeat):
+    """
+    Time building a road network (and writing its cache) and loading it from the cache,
+    then building the shelter routing table and loading it from the cache.
+    """
+
+    geo_series = read_vector(data_params["road_network_shp"], crs=data_params["crs"])["geometry"]
+    shelters = read_vector(data_params["shelters_shp"], crs=data_params["crs"])
+    end_points = [Point(xy) for xy in zip(shelters.geometry.x, shelters.geometry.y)]
+    network_class = NETWORK_BACKENDS[backend]
+
+    build, load, paths_build, paths_load = [], [], [], []
+    for _ in range(repeat):
+        with tempfile.TemporaryDirectory() as cache_dir:
+            build += time_calls(lambda: network_class(geo_series, cache_dir=cache_dir), 1)
+            load += time_calls(lambda: network_class(geo_series, cache_dir=cache_dir), 1)
+            network = network_class(geo_series, cache_dir=cache_dir)
+            paths_build += time_calls(lambda: network.batch_calculate_shortest_paths([], end_points), 1)
+            network = network_class(geo_series, cache_dir=cache_dir)
+            paths_load += time_calls(lambda: network.batch_calculate_shortest_paths([], end_points), 1)
+
+    params = {"network_backend": backend, "n_segments": len(geo_series)}
+    return [
+        {"benchmark": "network_build", **params, "times": summarize(build)},
+        {"benchmark": "network_load", **params, "times": summarize(load)},
+        {"benchmark": "shortest_paths_build", **params, "times": summarize(paths_build)},
+        {"benchmark": "shortest_paths_load", **params, "times": summarize(paths_load)},
+    ]
+
+def bench_model(data_params, num_residents, engine, steps, repeat, model_params, cache_dir):
+    """
+    Time EvacuationModel.__init__, then each step() of a run of at most `steps` steps.
+    The network cache of the dataset, in cache_dir, is warm, it is built by the first model.
+    """
+
+    params = {"engine": engine, "num_residents": num_residents}
+    n_population = len(read_vector(data_params["population_distribution_shp"], crs=data_params["crs"]))
+    if num_residents > n_population:
+        skipped = {**params, "skipped": f"the dataset has {n_population} resident locations"}
+        return [{"benchmark": "model_init", **skipped}, {"benchmark": "model_step", **skipped}]
+
+    def create_model():
+        return EvacuationModel(num_residents=num_residents, engine=engine, sync_agents=False, rng=0,
+                               cache_dir=cache_dir, **model_params, **data_params)
+
+    create_model()
+    init = time_calls(create_model, repeat)
+
+    model = create_model()
+    step_times = []
+    while model.running and model.steps < steps:
+        step_times += time_calls(model.step, 1)
+    return [
+        {"benchmark": "model_init", **params, "times": summarize(init)},
+        {
+            "benchmark": "model_step", **params, "steps": model.steps, "total": float(np.sum(step_times)),
+            "n_evacuated": int(model.n_evacuated), "n_dead": int(model.n_dead), "times": summarize(step_times),
+        },
+    ]
+
+def get_environment():
+    # The code version and the machine the benchmarks ran on
+    try:
+        commit = subprocess.run(
+            ["git", "rev-parse", "HEAD"], capture_output=True, text=True, cwd=os.path.dirname(os.path.abspath(__file__))
+        ).stdout.strip() or None
+    except OSError:
+        commit = None
+    return {
+        "commit": commit,
+        "date": datetime.datetime.now().isoformat(timespec="seconds"),
+        "python": sys.version.split()[0],
+        "numpy": np.__version__,
+        "platform": platform.platform(),
+        "processor": platform.processor(),
+        "cpu_count": os.cpu_count(),
+    }
+
+def run_benchmarks(datasets=("pcs", "grid"), sizes=(100, 500, 2000, 10000), engines=("agents", "vectorized"),
+                   backends=("networkx", "sparse"), steps=900, repeat=3, grid_size=30, model_params=None):
+    """
+    Run the benchmark suite.
+    :param datasets: "pcs" for the bundled dataset, "grid" for a generated grid dataset.
+    :type datasets: Iterable[str]
+    :param sizes: The numbers of residents of the model benchmarks.
+    :type sizes: Iterable[int]
+    :param engines: The resident engines of the model benchmarks.
+    :type engines: Iterable[str]
+    :param backends: The road network backends of the network benchmarks.
+    :type backends: Iterable[str]
+    :param steps: The maximum number of steps timed per model.
+    :type steps: int
+    :param repeat: The number of repetitions of the build, load and init benchmarks.
+    :type repeat: int
+    :param grid_size: The number of intersections along each side of the generated grid.
+    :type grid_size: int
+    :param model_params: Other EvacuationModel parameters, by default a short milling
+        time so the residents move within the timed steps.
+    :type model_params: dict
+    :return: The environment and one result per benchmark.
+    :rtype: dict
+    """
+
+    model_params = {"Rtau": 5} if model_params is None else model_params
+    results = []
+    # The datasets and the network caches of the models are temporary, the cache of the repository is left alone
+    with tempfile.TemporaryDirectory() as directory:
+        cache_dir = os.path.join(directory, "cache")
+        for dataset in datasets:
+            if dataset == "pcs":
+                data_params = {
+                    "road_network_shp": EvacuationModel.road_network_shp,
+                    "population_distribution_shp": EvacuationModel.population_distribution_shp,
+                    "shelters_shp": EvacuationModel.shelters_shp,
+                    "hazard_raster": EvacuationModel.hazard_raster,
+                    "crs": EvacuationModel.crs,
+                }
+            elif dataset == "grid":
+                data_params = make_grid_dataset(os.path.join(directory, "grid"), grid_size=grid_size,
+                                                n_population=max(10000, *sizes))
+            else:
+                raise ValueError(f"Unknown dataset: {dataset}")
+
+            benchmarks = [lambda backend=backend: bench_network(data_params, backend, repeat) for backend in backends]
+            benchmarks += [
+                lambda n=n, engine=engine: bench_model(data_params, n, engine, steps, repeat, model_params, cache_dir)
+                for n in sizes for engine in engines
+            ]
+            for benchmark in benchmarks:
+                for result in benchmark():
+                    result = {"dataset": dataset, **({"grid_size": grid_size} if dataset == "grid" else {}), **result}
+                    results.append(result)
+                    print(format_result(result))
+
+    return {
+        "environment": get_environment(),
+        "parameters": {"steps": steps, "repeat": repeat, "grid_size": grid_size, "model_params": model_params},
+        "results": results,
+    }
+
+def get_result_key(result):
+    # What identifies a benchmark across runs
+    return tuple((name, value) for name, value in result.items() if name not in ("times", "total", "steps", "n_evacuated", "n_dead"))
+
+def get_score(result):
+    # The time compared between runs, the mean for the steps as their cost varies over the run
+    return result["times"]["mean" if result["benchmark"] == "model_step" else "median"]
+
+def format_result(result):
+    name = ", ".join(f"{value}" for _, value in get_result_key(result))
+    if "skipped" in result:
+        return f"{name}: skipped"
+    statistic = "mean" if result["benchmark"] == "model_step" else "median"
+    return f"{name}: {statistic} {get_score(result) * 1000:.2f} ms over {result['times']['n']}"
+
+def compare(baseline, current, threshold=0.1):
+    """
+    Compare the times of two benchmark results, as returned by run_benchmarks: the
+    median time of a call, or the mean time of a step for the model steps.
+    :param threshold: The relative slowdown reported as a regression.
+    :type threshold: float
+    :return: The key, baseline and current times and ratio of the regressions.
+    :rtype: list[tuple]
+    """
+
+    baseline_times = {get_result_key(result): get_score(result) for result in baseline["results"] if "times" in result}
+    regressions = []
+    for result in current["results"]:
+        key = get_result_key(result)
+        if "times" not in result or key not in baseline_times:
+            continue
+        ratio = get_score(result) / baseline_times[key]
+        print(f"{format_result(result)}, {ratio:.2f}x baseline")
+        if ratio > 1 + threshold:
+            regressions.append((key, baseline_times[key], get_score(result), ratio))
+    return regressions
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmark the road network and the evacuation model.")
+    parser.add_argument("--datasets", nargs="+", default=["pcs", "grid"], choices=["pcs", "grid"])
+    parser.add_argument("--sizes", nargs="+", type=int, default=[100, 500, 2000, 10000])
+    parser.add_argument("--engines", nargs="+", default=["agents", "vectorized"], choices=["agents", "vectorized"])
+    parser.add_argument("--backends", nargs="+", default=["networkx", "sparse"], choices=list(NETWORK_BACKENDS))
+    parser.add_argument("--steps", type=int, default=900, help="maximum number of steps timed per model")
+    parser.add_argument("--repeat", type=int, default=3)
+    parser.add_argument("--grid-size", type=int, default=30, help="intersections along each side of the generated grid")
+    parser.add_argument("--output", default="benchmark_results.json")
+    parser.add_argument("--baseline", help="results of a previous run to compare against")
+    parser.add_argument("--threshold", type=float, default=0.1, help="relative slowdown reported as a regression")
+    args = parser.parse_args()
+
+    report = run_benchmarks(args.datasets, args.sizes, args.engines, args.backends, args.steps, args.repeat, args.grid_size)
+    with open(args.output, "w") as f:
+        json.dump(report, f, indent=2)
+    print(f"Results written to {args.output}")
+
+    if args.baseline is not None:
+        with open(args.baseline) as f:
+            regressions = compare(json.load(f), report, args.threshold)
+        for key, before, after, ratio in regressions:
+            print(f"Regression: {dict(key)}, {before * 1000:.2f} ms -> {after * 1000:.2f} ms ({ratio:.2f}x)")
+        sys.exit(1 if regressions else 0)
@@ -1,15 +1,132 @@
-import mesa
 import mesa_geo as mg
-import rasterio as rio
+import numpy as np
 
 class FireHazardCell(mg.Cell):
+    """
+    A cell of the FireHazardLayer. Its attributes are read from the arrays of the layer,
+    so they are only looked up when something (e.g. the visualization) asks for them.
+    """
+
     def __init__(self, model, pos, indices):
         super().__init__(model, pos, indices)
-        self.fire_arrival_time = None  # in minutes
-        self.is_burnt = False  # boolean
+        self.layer = None  # set by the FireHazardLayer
+
+    @property
+    def fire_arrival_time(self):
+        # in minutes
+        return self.layer.fire_arrival_time[self.indices]
+
+    @property
+    def is_burnt(self):
+        # boolean
+        return self.layer.is_burnt[self.indices]
+
+class FireHazardLayer(mg.RasterLayer):
+    """
+    Raster layer of the fire hazard. The fire arrival time and the burn state of all
+    cells are kept as (height, width) arrays, in the row order of the raster file.
+
+    The burnable cells are sorted by arrival time once, each step advances a pointer
+    over them and only sets the cells ignited since the last step, which are exposed
+    as `newly_burnt` (row and column index arrays) for incremental consumers.
+    """
+
+    array_attributes = ("fire_arrival_time", "is_burnt")
+
+    # RGBA colors of the burnt cells, from the fire arrival time color_range[0] (first color)
+    # to color_range[1] minutes (last color), set by the visualization. Without it, to_image
+    # calls the portrayal method for every cell
+    color_lut = None
+    color_range = (0, 120)
+
+    def __init__(self, width, height, crs, total_bounds, model):
+        super().__init__(width, height, crs, total_bounds, model, FireHazardCell)
+        for cell in self:
+            cell.layer = self
+        self.fire_arrival_time = np.full((height, width), -9999.0)  # in minutes
+        self.fire_arrival_seconds = np.full((height, width), np.inf)  # inf where the fire never arrives
+        self.is_burnt = np.zeros((height, width), dtype=bool)
+        self.burn_order = np.empty(0, dtype=np.int64)  # flat indices of the burnable cells, by arrival time
+        self.burn_times = np.empty(0)  # their arrival times in seconds
+        self.burn_pointer = 0  # number of cells of burn_order already ignited
+        self.newly_burnt = (np.empty(0, dtype=np.int64), np.empty(0, dtype=np.int64))
+        self._image = None  # the last image, see to_image
+        self._image_values = None
+        self._image_pointer = 0  # burn_pointer when the image was last updated
+
+    def apply_raster(self, data, attr_name=None):
+        if attr_name not in self.array_attributes:
+            return super().apply_raster(data, attr_name)
+        if data.shape != (1, self.height, self.width):
+            raise ValueError(
+                f"Data shape does not match raster shape. "
+                f"Expected {(1, self.height, self.width)}, received {data.shape}."
+            )
+        self._attributes.add(attr_name)
+        if attr_name == "fire_arrival_time":
+            self.fire_arrival_time = data[0].astype(float)
+            self.fire_arrival_seconds = np.where(self.fire_arrival_time == -9999, np.inf, self.fire_arrival_time * 60)
+            burnable = np.flatnonzero(np.isfinite(self.fire_arrival_seconds))
+            self.burn_order = burnable[np.argsort(self.fire_arrival_seconds.flat[burnable], kind="stable")]
+            self.burn_times = self.fire_arrival_seconds.flat[self.burn_order]
+        else:
+            self.is_burnt = data[0].astype(bool)
+        self.burn_pointer = 0
+        self._image = None
+
+    def get_raster(self, attr_name=None):
+        if attr_name not in self.array_attributes:
+            return super().get_raster(attr_name)
+        return getattr(self, attr_name)[np.newaxis].astype(float)
 
     def step(self):
+        # Ignite the cells whose arrival time has passed since the last step
+        end = np.searchsorted(self.burn_times, self.model.time_elapsed, side="right")
+        ignited = self.burn_order[self.burn_pointer:end]
+        ignited = ignited[~self.is_burnt.flat[ignited]]
+        self.is_burnt.flat[ignited] = True
+        self.burn_pointer = max(self.burn_pointer, end)
+        self.newly_burnt = np.unravel_index(ignited, self.is_burnt.shape)
+
+    def to_image(self, colormap):
+        """
+        The burnt cells colored by their fire arrival time through `color_lut`, as one
+        image. Only the cells ignited since the last image are colored, and the image
+        (and its reprojection) is reused as long as no cell ignites.
+        """
+
+        if self.color_lut is None:
+            return super().to_image(colormap)
+        if self._image is None or self._image_pointer > self.burn_pointer:
+            # Color all the burnt cells
+            self._image_values = np.zeros((4, self.height, self.width))
+            cells = np.flatnonzero(self.is_burnt & (self.fire_arrival_time != -9999))
+        elif self._image_pointer < self.burn_pointer:
+            cells = self.burn_order[self._image_pointer:self.burn_pointer]
+        else:
+            return self._image
+
+        # Bins of the arrival times over color_range, as a matplotlib colormap with len(color_lut) colors
+        lut = np.asarray(self.color_lut, dtype=float)
+        min_value, max_value = self.color_range
+        bins = (self.fire_arrival_time.flat[cells] - min_value) / (max_value - min_value) * len(lut)
+        bins = np.clip(np.floor(bins), 0, len(lut) - 1).astype(np.int64)
+        self._image_values.reshape(4, -1)[:, cells] = lut[bins].T
+        self._image_pointer = self.burn_pointer
+        self._image = FireImageLayer(self._image_values, self.crs, self.total_bounds)
+        return self._image
+
+class FireImageLayer(mg.ImageLayer):
+    """An image of the FireHazardLayer, reprojected once per CRS."""
+
+    def __init__(self, values, crs, total_bounds):
+        super().__init__(values, crs, total_bounds)
+        self._reprojected = {}
 
-        if (self.model.time_elapsed >= self.fire_arrival_time * 60) and (self.is_burnt == False) and (self.fire_arrival_time != -9999):
-            self.is_burnt = True
-        
+    def to_crs(self, crs, inplace=False):
+        if inplace:
+            return super().to_crs(crs, inplace=True)
+        key = str(crs)
+        if key not in self._reprojected:
+            self._reprojected[key] = super().to_crs(crs)
+        return self._reprojected[key]
@@ -0,0 +1,62 @@
+import functools
+import os
+from collections import namedtuple
+import geopandas as gpd
+import rasterio as rio
+
+# A raster band stack with the metadata the model needs
+Raster = namedtuple("Raster", ["values", "width", "height", "transform", "bounds", "crs"])
+
+def read_vector(path, columns=(), crs=None):
+    """
+    Read a vector file, keeping only the geometry and the given attribute columns.
+    The parsed frame is cached per process and shared by every caller, so it must
+    not be modified in place.
+    :param path: The path of the vector file.
+    :type path: str
+    :param columns: The attribute columns to read, none by default.
+    :type columns: Iterable[str]
+    :param crs: The CRS to reproject the geometries to, the file CRS if None.
+    :type crs: str
+    :return: The geometries and the requested columns.
+    :rtype: gpd.GeoDataFrame
+    """
+
+    return _read_vector(os.path.abspath(path), tuple(columns), crs)
+
+@functools.lru_cache(maxsize=None)
+def _read_vector(path, columns, crs):
+    gdf = gpd.read_file(path, columns=list(columns))
+    if crs is not None and gdf.crs is not None and not gdf.crs.equals(crs):
+        gdf = gdf.to_crs(crs)
+    return gdf
+
+def read_raster(path, crs=None):
+    """
+    Read all the bands of a raster file. The values are cached per process, shared
+    by every caller and read only.
+    :param path: The path of the raster file.
+    :type path: str
+    :param crs: The CRS the raster is expected to be in, not checked if None.
+    :type crs: str
+    :return: The values, with shape (bands, height, width), and the raster metadata.
+    :rtype: Raster
+    """
+
+    raster = _read_raster(os.path.abspath(path))
+    if crs is not None and raster.crs is not None and raster.crs != rio.crs.CRS.from_user_input(crs):
+        raise ValueError(f"The raster {path} is in {raster.crs}, expected {crs}")
+    return raster
+
+@functools.lru_cache(maxsize=None)
+def _read_raster(path):
+    with rio.open(path) as src:
+        values = src.read()
+        values.flags.writeable = False
+        return Raster(values, src.width, src.height, src.transform, list(src.bounds), src.crs)
+
+def clear_cache():
+    """Drop the cached data of this process."""
+
+    _read_vector.cache_clear()
+    _read_raster.cache_clear()
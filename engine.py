@@ -0,0 +1,282 @@
+import numpy as np
+from shapely.geometry import Point
+from traffic import GMModelVectorized
+from profiler import phase
+
+# Resident status codes, stranded residents have decided to leave but no shelter is reachable
+WAITING, EVACUATING, EVACUATED, DEAD, STRANDED = 0, 1, 2, 3, 4
+STATUS_NAMES = np.array(["waiting", "evacuating", "evacuated", "dead", "stranded"], dtype=object)
+STATUS_CODES = {name: code for code, name in enumerate(STATUS_NAMES)}
+
+class ResidentEngine:
+    """
+    Struct-of-arrays state of all residents, stepped in one vectorized pass.
+
+    Produces the same results as the agents engine with simultaneous updates
+    (EvacuationModel(engine="agents", update="simultaneous")): the
+    agents keep their initial state (origin, path, decision time) and are only
+    used as views of the arrays, refreshed by `sync_agents` for visualization.
+    """
+
+    def __init__(self, model, residents, look_ahead=100):
+        self.model = model
+        self.residents = list(residents)
+        self.look_ahead = look_ahead
+        self.car_following = GMModelVectorized(model)
+
+        n = len(self.residents)
+        self.x = np.array([agent.geometry.x for agent in self.residents], dtype=float)
+        self.y = np.array([agent.geometry.y for agent in self.residents], dtype=float)
+        self.speed = np.array([agent.speed for agent in self.residents], dtype=float)
+        self.heading = np.array([agent.heading for agent in self.residents], dtype=float)
+        self.status = np.array([STATUS_CODES[agent.status] for agent in self.residents], dtype=np.int8)
+        self.decision_time = np.array([agent.decision_time for agent in self.residents], dtype=float)
+        self.distance_to_dest = np.array([agent.distance_to_dest for agent in self.residents], dtype=float)
+        self.evacuation_time = np.array([agent.evacuation_time for agent in self.residents], dtype=float)
+        self.progress = np.array([agent.path_progress for agent in self.residents], dtype=float)
+        self.path_index = np.array([agent.path_index for agent in self.residents], dtype=np.int64)
+
+        # The routes of all residents, concatenated
+        self.route_length = np.array([len(agent.route_edges) for agent in self.residents], dtype=np.int64)
+        self.route_start = np.concatenate([[0], np.cumsum(self.route_length)[:-1]]).astype(np.int64)
+        self.route_edges = np.concatenate([agent.route_edges for agent in self.residents] + [np.empty(0, dtype=np.int64)])
+        self.cum_start = self.route_start + np.arange(n)
+        self.route_cum = np.concatenate([agent.route_cum for agent in self.residents] + [np.empty(0)])
+        # The path vertices, laid out as route_cum (residents without a path get a placeholder vertex)
+        self.route_xy = np.concatenate(
+            [agent.route_xy if len(agent.route_xy) else np.full((1, 2), np.nan) for agent in self.residents] + [np.empty((0, 2))]
+        )
+
+        # Residents whose agent view is out of date
+        self.stale = np.zeros(n, dtype=bool)
+
+    def __len__(self):
+        return len(self.residents)
+
+    def step(self):
+        time_elapsed = self.model.time_elapsed
+        step_interval = self.model.step_interval
+
+        profiler = self.model.profiler
+
+        with phase(profiler, "status"):
+            # Residents registered on the road network at the start of the step
+            registered = np.flatnonzero((self.status == EVACUATING) & (self.route_length > 0))
+
+            # Update the status
+            in_fire = self.model.fire_reached(self.x, self.y)
+            status = np.where(
+                time_elapsed < self.decision_time,
+                WAITING,
+                np.where(self.route_length == 0, STRANDED, np.where(self.distance_to_dest >= 0, EVACUATING, EVACUATED)),
+            ).astype(np.int8)
+            status[in_fire] = DEAD
+            changed = np.flatnonzero(status != self.status)
+            for i in changed:
+                self.model.update_status(self.residents[i], STATUS_NAMES[self.status[i]], STATUS_NAMES[status[i]])
+            self.stale[changed] = True
+            self.status = status
+
+            # Record the evacuation time of newly evacuated residents
+            evacuated = np.flatnonzero((status == EVACUATED) & (self.evacuation_time > time_elapsed))
+            self.evacuation_time[evacuated] = time_elapsed / 60
+            self.model.evacuation_time_list.extend(self.evacuation_time[evacuated].tolist())
+
+        moving = np.flatnonzero(status == EVACUATING)
+        if moving.size == 0:
+            return
+
+        # Find the vehicles ahead on the road network
+        with phase(profiler, "leaders"):
+            leader = self.find_leaders(moving, registered)
+            has_leader = leader >= 0
+            leader = np.maximum(leader, 0)
+            dx = self.x[leader] - self.x[moving]
+            dy = self.y[leader] - self.y[moving]
+            space_hw = np.sqrt(dx * dx + dy * dy)
+
+        # Update speed using car following model
+        with phase(profiler, "car_following"):
+            speed = self.car_following.update_speed(self.speed[moving], self.speed[leader], space_hw, has_leader)
+            self.speed[moving] = speed
+
+        # Move along the path
+        with phase(profiler, "move"):
+            distance_to_travel = speed * step_interval
+            progress = self.progress[moving] + distance_to_travel
+            path_index = self._locate_path_index(moving, progress, self.path_index[moving])
+            points = np.column_stack((self.x[moving], self.y[moving]))
+            next_xy = self._interpolate(moving, progress, path_index)
+            # Residents without a path (no route found) stay where they are
+            missing = self.route_length[moving] == 0
+            next_xy[missing] = points[missing]
+            self.progress[moving] = progress
+
+            # Update the heading and the path edge
+            heading = (np.degrees(np.arctan2(next_xy[:, 0] - points[:, 0], next_xy[:, 1] - points[:, 1])) + 360) % 360
+            self.heading[moving] = heading
+            self.path_index[moving] = path_index
+
+            self.x[moving] = next_xy[:, 0]
+            self.y[moving] = next_xy[:, 1]
+            self.distance_to_dest[moving] -= distance_to_travel
+            self.stale[moving] = True
+
+    def set_routes(self, rows, paths, progress):
+        """
+        Give residents new paths, such as detours around the roads closed by the fire, see
+        Resident.set_route. The new routes are appended to the concatenated routes, the old
+        ones are left unused.
+        :param rows: The resident indices.
+        :type rows: list of int
+        :param paths: The new path of each resident, as a list of network nodes.
+        :type paths: list of list
+        :param progress: The distance along its new path of each resident.
+        :type progress: list of float
+        """
+
+        routes = [self.model.road_network.get_route_arrays(path) for path in paths]
+        route_start, cum_start = len(self.route_edges), len(self.route_cum)
+        for i, (edges, cum), row_progress in zip(rows, routes, progress):
+            self.route_start[i] = route_start
+            self.cum_start[i] = cum_start
+            self.route_length[i] = len(edges)
+            route_start += len(edges)
+            cum_start += len(cum)
+            self.progress[i] = row_progress
+            self.path_index[i] = min(max(int(np.searchsorted(cum, row_progress, side="right")) - 1, 0), len(edges) - 1)
+            self.distance_to_dest[i] = cum[-1] - row_progress
+        self.route_edges = np.concatenate([self.route_edges] + [edges for edges, _ in routes])
+        self.route_cum = np.concatenate([self.route_cum] + [cum for _, cum in routes])
+        self.route_xy = np.concatenate([self.route_xy] + [np.asarray(path, dtype=float).reshape(-1, 2) for path in paths])
+        self.stale[rows] = True
+
+    def next_event_time(self):
+        """
+        The time of the next event that can change a resident, when no resident is moving.
+        :return: The time in seconds of the next decision time or fire arrival in the cell
+            of a waiting or evacuated resident (inf if there is none), None while some
+            residents are moving.
+        :rtype: float
+        """
+
+        if (self.status == EVACUATING).any():
+            return None
+        waiting = self.status == WAITING
+        next_time = self.decision_time[waiting].min() if waiting.any() else np.inf
+        alive = np.flatnonzero(self.status != DEAD)
+        cell = self.model.get_cell_index(self.x[alive], self.y[alive])
+        arrival = self.model.fire_hazard_layer.fire_arrival_seconds.reshape(-1)[cell[cell >= 0]]
+        if arrival.size > 0:
+            next_time = min(next_time, arrival.min())
+        return float(next_time)
+
+    def _locate_path_index(self, rows, progress, path_index):
+        # Move each path index to the edge containing progress, as Resident.locate_path_index
+        path_index = np.minimum(path_index, np.maximum(self.route_length[rows] - 1, 0))
+        cum_start = self.cum_start[rows]
+        last = self.route_length[rows] - 1
+        with np.errstate(invalid="ignore"):
+            while True:
+                forward = (path_index < last) & (progress >= self.route_cum[np.minimum(cum_start + path_index + 1, len(self.route_cum) - 1)])
+                backward = (path_index > 0) & (progress < self.route_cum[cum_start + path_index])
+                if not (forward.any() or backward.any()):
+                    return path_index
+                path_index = path_index + forward - backward
+
+    def _interpolate(self, rows, progress, path_index):
+        # The points at progress along the paths, as Resident.get_point_at
+        vertex = self.cum_start[rows] + np.minimum(path_index, np.maximum(self.route_length[rows] - 1, 0))
+        following = np.minimum(vertex + 1, len(self.route_cum) - 1)
+        start_cum = self.route_cum[vertex]
+        length = self.route_cum[following] - start_cum
+        with np.errstate(invalid="ignore", divide="ignore"):
+            t = np.where(length > 0, np.minimum(np.maximum((progress - start_cum) / length, 0.0), 1.0), 0.0)
+        start = self.route_xy[vertex]
+        return start + t[:, np.newaxis] * (self.route_xy[following] - start)
+
+    def find_leaders(self, rows, registered):
+        """
+        Vectorized form of RoadNetwork.find_leader for the residents in `rows`.
+        :param rows: The residents looking for a vehicle ahead.
+        :type rows: np.ndarray
+        :param registered: The residents registered on the road network.
+        :type registered: np.ndarray
+        :return: The resident ahead of each resident in `rows`, or -1.
+        :rtype: np.ndarray
+        """
+
+        leader = np.full(rows.size, -1, dtype=np.int64)
+        routed = self.route_length[rows] > 0
+        rows = rows[routed]
+        if rows.size == 0 or registered.size == 0:
+            return leader
+        found = np.flatnonzero(routed)
+
+        # Position of the querying residents along their paths
+        progress = self.progress[rows]
+        path_index = self.path_index[rows]
+        edge = self.route_edges[self.route_start[rows] + path_index]
+        offset = progress - self.route_cum[self.cum_start[rows] + path_index]
+
+        # Registered vehicles sorted by (edge, offset, id)
+        reg_edge = self.route_edges[self.route_start[registered] + self.path_index[registered]]
+        reg_offset = self.progress[registered] - self.route_cum[self.cum_start[registered] + self.path_index[registered]]
+        order = np.lexsort((registered, reg_offset, reg_edge))
+        reg_edge, reg_offset, reg_id = reg_edge[order], reg_offset[order], registered[order]
+
+        # Next vehicle on the same edge: sort the queries in with the vehicles, after equal keys
+        all_edge = np.concatenate([reg_edge, edge])
+        all_offset = np.concatenate([reg_offset, offset])
+        all_id = np.concatenate([reg_id, rows])
+        all_kind = np.concatenate([np.ones(reg_id.size, dtype=np.int8), np.zeros(rows.size, dtype=np.int8)])
+        merged = np.lexsort((all_kind, all_id, all_offset, all_edge))
+        rank = np.empty(merged.size, dtype=np.int64)
+        rank[merged] = np.arange(merged.size)
+        reg_rank = rank[:reg_id.size]
+        candidate = np.searchsorted(reg_rank, rank[reg_id.size:], side="right")
+        twin = (candidate < reg_id.size) & (reg_id[np.minimum(candidate, reg_id.size - 1)] == rows)
+        candidate = candidate + twin
+        same_edge = (candidate < reg_id.size) & (reg_edge[np.minimum(candidate, reg_id.size - 1)] == edge)
+        candidate = np.minimum(candidate, reg_id.size - 1)
+        accept = same_edge & (reg_offset[candidate] - offset <= self.look_ahead)
+        leader[found[accept]] = reg_id[candidate[accept]]
+
+        # First vehicle on the downstream edges of the route
+        pending = np.flatnonzero(~same_edge)
+        next_index = path_index[pending] + 1
+        while pending.size > 0:
+            route_rows = rows[pending]
+            active = next_index < self.route_length[route_rows]
+            gap = np.full(pending.size, np.inf)
+            gap[active] = self.route_cum[self.cum_start[route_rows[active]] + next_index[active]] - progress[pending[active]]
+            active &= gap <= self.look_ahead
+            pending, next_index, gap, route_rows = pending[active], next_index[active], gap[active], route_rows[active]
+
+            next_edge = self.route_edges[self.route_start[route_rows] + next_index]
+            first = np.searchsorted(reg_edge, next_edge, side="left")
+            occupied = (first < reg_id.size) & (reg_edge[np.minimum(first, reg_id.size - 1)] == next_edge)
+            first = np.minimum(first, reg_id.size - 1)
+            accept = occupied & (gap + reg_offset[first] <= self.look_ahead)
+            leader[found[pending[accept]]] = reg_id[first[accept]]
+
+            pending, next_index = pending[~occupied], next_index[~occupied] + 1
+
+        return leader
+
+    def get_status(self):
+        return STATUS_NAMES[self.status]
+
+    def sync_agents(self):
+        """Copy the array state into the `Resident` agents that changed since the last sync."""
+
+        for i in np.flatnonzero(self.stale):
+            agent = self.residents[i]
+            agent.geometry = Point(self.x[i], self.y[i])
+            agent.speed = float(self.speed[i])
+            agent.next_speed = agent.speed
+            agent.heading = float(self.heading[i])
+            agent.status = str(STATUS_NAMES[self.status[i]])
+            agent.distance_to_dest = float(self.distance_to_dest[i])
+            agent.evacuation_time = float(self.evacuation_time[i])
+        self.stale[:] = False
@@ -1,13 +1,16 @@
 import mesa
 import mesa_geo as mg
-from shapely.geometry import Point, Polygon, shape
+from shapely.geometry import Point, shape
 import geopandas as gpd
 from agents import Resident, Shelter, FireHazard
-from road_network import RoadNetwork
+from road_network import RoadNetwork, SparseRoadNetwork
 from space import StudyArea
-from cell import FireHazardCell
-import rasterio as rio
-from rasterio.transform import Affine
+from engine import ResidentEngine, STATUS_CODES, STATUS_NAMES
+from scheduler import ResidentScheduler
+from rerouting import FireRerouter
+from cell import FireHazardLayer
+from data_loader import read_vector, read_raster
+from profiler import phase
 import rasterio.features
 import numpy as np
 import pandas as pd
@@ -40,10 +43,8 @@ class EvacuationModel(mesa.Model):
     #     with rio.open(hazard_raster_translated, 'w', **meta) as dst:
     #         dst.write(data, 1)
         
-    # Create gdf for the shapefile
-    population_distribution_gdf = gpd.read_file(population_distribution_shp)
-    shelters_gdf = gpd.read_file(shelters_shp)
-    road_network_gdf = gpd.read_file(road_network_shp)
+    # The CRS of the model, the shapefiles are reprojected to it
+    crs = "EPSG:32611"
 
     def __init__(
         self, 
@@ -54,16 +55,60 @@ class EvacuationModel(mesa.Model):
         deceleration=25, 
         alpha=0.14, 
         Rtau=45, 
-        Rsig=1.65
+        Rsig=1.65,
+        engine="agents",
+        sync_agents=True,
+        network_backend="networkx",
+        population_distribution_shp=None,
+        shelters_shp=None,
+        road_network_shp=None,
+        hazard_raster=None,
+        crs=None,
+        cache_dir="cache",
+        rng=None,
+        recorder=None,
+        fast_forward=False,
+        profiler=None,
+        reroute=False,
+        update=None
     ):
-        super().__init__()
-        self.space = StudyArea(crs="EPSG:32611",warn_crs_conversion=True)
-        self.road_network = RoadNetwork(geo_series=self.road_network_gdf['geometry'], use_cache=True)
+        # rng seeds the random number generator of the model (self.rng), drawing the residents and
+        # their decision times. It can be an int, a np.random.SeedSequence or a np.random.Generator,
+        # a new generator is seeded from the operating system if None
+        super().__init__(rng=rng)
+
+        # Input data, the class attributes are used by default. The files are read on first
+        # use and shared by all the models of the process, only the geometries are kept
+        if population_distribution_shp is not None:
+            self.population_distribution_shp = population_distribution_shp
+        if shelters_shp is not None:
+            self.shelters_shp = shelters_shp
+        if road_network_shp is not None:
+            self.road_network_shp = road_network_shp
+        if hazard_raster is not None:
+            self.hazard_raster = hazard_raster
+        if crs is not None:
+            self.crs = crs
+        self.population_distribution_gdf = read_vector(self.population_distribution_shp, crs=self.crs)
+        self.shelters_gdf = read_vector(self.shelters_shp, crs=self.crs)
+        self.road_network_gdf = read_vector(self.road_network_shp, crs=self.crs)
+
+        self.space = StudyArea(crs=self.crs,warn_crs_conversion=True)
+        if network_backend == "networkx":
+            self.road_network = RoadNetwork(geo_series=self.road_network_gdf['geometry'], cache_dir=cache_dir, use_cache=True)
+        elif network_backend == "sparse":
+            self.road_network = SparseRoadNetwork(geo_series=self.road_network_gdf['geometry'], cache_dir=cache_dir, use_cache=True)
+        else:
+            raise ValueError(f"Unknown network backend: {network_backend}")
         self.steps = 0
         self.step_interval = 1 # How many seconds each step represents
         self.time_elapsed = self.steps * self.step_interval # The total time elapsed in seconds
         self.running = True
 
+        # Fast forward through the steps where no resident can change, see skip_idle_steps
+        self.fast_forward = fast_forward
+        self.max_steps = None # The last step a fast forward can skip to, unbounded if None
+
         # Model parameters
         self.num_steps = num_steps
         self.num_residents = num_residents
@@ -74,6 +119,27 @@ class EvacuationModel(mesa.Model):
         self.deceleration = float(deceleration) # ft/s^2
         self.alpha = float(alpha) # mile^2/hr
 
+        # Resident engine, "agents" steps every Resident, "vectorized" steps a ResidentEngine
+        # and only syncs the Resident agents (for visualization) when sync_agents is True
+        if engine not in ("agents", "vectorized"):
+            raise ValueError(f"Unknown engine: {engine}")
+        self.engine = engine
+
+        # How the residents are updated in a step, "sequential" (the default of the agents engine)
+        # moves each resident as soon as it has chosen its speed, in the order the residents were
+        # created, "simultaneous" chooses every speed from the state at the start of the step and
+        # then moves every resident, which is what the vectorized engine does
+        if update is None:
+            update = "sequential" if engine == "agents" else "simultaneous"
+        if update not in ("sequential", "simultaneous"):
+            raise ValueError(f"Unknown update: {update}")
+        if engine == "vectorized" and update == "sequential":
+            raise ValueError("The vectorized engine only supports simultaneous updates")
+        self.update = update
+        self.sync_agents = sync_agents
+        self.resident_engine = None
+        self.resident_scheduler = None
+
         # Decision making time parameter
         self.Rtau = float(Rtau) # The milling time in minutes, the time it takes for a resident to receive the notification
         self.Rsig = float(Rsig) # The scale factor parameter
@@ -81,14 +147,18 @@ class EvacuationModel(mesa.Model):
         # Statistics
         self.n_evacuated = 0
         self.n_dead = 0
+        self.n_stranded = 0  # residents who decided to leave with no shelter reachable
         self.evacuation_time_list = []
+        # Number of residents and set of residents in each status, updated as statuses change
+        self.status_counts = {status: 0 for status in STATUS_NAMES}
+        self.residents_by_status = {status: set() for status in STATUS_NAMES}
+        self.recorder = recorder  # optional Recorder streaming the outputs to files
+        self.profiler = profiler  # optional Profiler timing the phases of the steps
 
-        # Build shortest path cache
-        start_points_gdf = self.population_distribution_gdf.sample(n=self.num_residents)
-        start_points = [Point(xy) for xy in zip(start_points_gdf.geometry.x, start_points_gdf.geometry.y)]
+        # Build the shortest path trees of the shelters
         end_points_gdf = self.shelters_gdf
         end_points = [Point(xy) for xy in zip(end_points_gdf.geometry.x, end_points_gdf.geometry.y)]
-        self.road_network.batch_calculate_shortest_paths(start_points, end_points)
+        self.road_network.batch_calculate_shortest_paths([], end_points)
 
         # Create agents
         shelter_ag_creator = mg.AgentCreator(Shelter, model=self)
@@ -96,27 +166,36 @@ class EvacuationModel(mesa.Model):
         self.space.add_agents(shelter_agents)
 
         resident_ag_creator = mg.AgentCreator(Resident, model=self)
-        resident_agents = resident_ag_creator.from_GeoDataFrame(self.population_distribution_gdf.sample(n=self.num_residents))
+        resident_agents = resident_ag_creator.from_GeoDataFrame(self.population_distribution_gdf.sample(n=self.num_residents, random_state=self.rng))
         self.space.add_agents(resident_agents)
+        if self.engine == "vectorized":
+            self.resident_engine = ResidentEngine(self, resident_agents)
 
         # Create fire hazard cells
-        with rio.open(self.hazard_raster) as src:  
-            values = src.read()      
-            width = src.width
-            height = src.height
-            transform = src.transform      
-            bounds = list(src.bounds)
-            self.transform = transform
-            hazard_raster_layer = mg.RasterLayer(width, height, "EPSG:32611", bounds, self, FireHazardCell)
-            hazard_raster_layer.apply_raster(values, "fire_arrival_time")
-            hazard_raster_layer.apply_raster(np.zeros_like(values), "is_burnt")
-            self.space.add_layer(hazard_raster_layer)
+        raster = read_raster(self.hazard_raster, crs=self.crs)
+        values = raster.values
+        transform = raster.transform
+        self.transform = transform
+        # The inverse transform, from coordinates to raster columns and rows
+        self.inverse_transform = ~transform
+        hazard_raster_layer = FireHazardLayer(raster.width, raster.height, self.crs, raster.bounds, self)
+        hazard_raster_layer.apply_raster(values, "fire_arrival_time")
+        hazard_raster_layer.apply_raster(np.zeros_like(values), "is_burnt")
+        self.space.add_layer(hazard_raster_layer)
+        self.fire_hazard_layer = hazard_raster_layer
+
+        # The agents engine only activates the residents that can change in a step
+        if self.engine == "agents":
+            self.resident_scheduler = ResidentScheduler(self, resident_agents, sequential=self.update == "sequential")
+
+        # Residents reroute around the road edges closed by the fire, see FireRerouter
+        self.rerouter = FireRerouter(self, resident_agents) if reroute else None
 
         # Creare the fire hazard geoagent
         mask = values > 0
         hazard_shapes = list(rasterio.features.shapes(values, mask=mask, transform=transform))
         hazard_geoms = [shape(geom) for geom, value in hazard_shapes if value >= 0]
-        hazard_gdf = gpd.GeoDataFrame(geometry=hazard_geoms, crs="EPSG:32611")
+        hazard_gdf = gpd.GeoDataFrame(geometry=hazard_geoms, crs=self.crs)
         hazard_ag_creator = mg.AgentCreator(FireHazard, model=self)
         hazard_agents = hazard_ag_creator.from_GeoDataFrame(hazard_gdf.dissolve())
         # self.space.add_agents(hazard_agents)
@@ -128,38 +207,157 @@ class EvacuationModel(mesa.Model):
                 # "agents evacuated": get_count_agent_evacuated,
                 "Evacuated": "n_evacuated",
                 "Casuality": "n_dead",
-                "Percentage of Casuality": lambda m: m.n_dead / m.num_residents * 100,
-                "Percentage of Evacuated": lambda m: m.n_evacuated / m.num_residents * 100,
-                "Evacuation Time": lambda m: m.evacuation_time_list,
+                "Stranded": "n_stranded",
+                "Percentage of Casuality": lambda m: m.n_dead / max(m.num_residents, 1) * 100,
+                "Percentage of Evacuated": lambda m: m.n_evacuated / max(m.num_residents, 1) * 100,
             }
         )
         self.datacollector.collect(self)
+        if self.recorder is not None:
+            self.recorder.record(self)
+
+    def fire_reached(self, x, y):
+        """
+        Check if the fire has reached the hazard raster cells containing the given coordinates.
+        :param x: The x coordinates, a scalar or an array.
+        :param y: The y coordinates, a scalar or an array.
+        :return: True where the fire arrival time of the cell has passed, False outside the raster.
+        :rtype: np.ndarray
+        """
+
+        cell = self.get_cell_index(x, y)
+        inside = cell >= 0
+        arrival = self.fire_hazard_layer.fire_arrival_seconds.reshape(-1)[np.where(inside, cell, 0)]
+        return inside & (arrival <= self.time_elapsed)
+
+    def get_cell_index(self, x, y):
+        """
+        Get the flat index (row * width + col) of the hazard raster cells containing the given coordinates.
+        :param x: The x coordinates, a scalar or an array.
+        :param y: The y coordinates, a scalar or an array.
+        :return: The cell indices, -1 outside the raster.
+        :rtype: np.ndarray
+        """
+
+        col, row = self.inverse_transform @ (np.asarray(x, dtype=float), np.asarray(y, dtype=float))
+        row = np.floor(row).astype(np.int64)
+        col = np.floor(col).astype(np.int64)
+        height, width = self.fire_hazard_layer.fire_arrival_seconds.shape
+        inside = (row >= 0) & (row < height) & (col >= 0) & (col < width)
+        return np.where(inside, row * width + col, -1)
+
+    def get_step_at(self, seconds):
+        # The first step whose time elapsed is at least the given time in seconds
+        step = int(np.ceil(seconds / self.step_interval))
+        if (step - 1) * self.step_interval >= seconds:
+            step -= 1
+        elif step * self.step_interval < seconds:
+            step += 1
+        return step
+
+    def skip_idle_steps(self):
+        """
+        Skip the steps before the next event when no resident is moving: the next decision
+        time, the next fire arrival in the cell of a waiting or evacuated resident, or the next
+        road closure when rerouting. Nothing
+        changes in the skipped steps, only their data is collected (and recorded), so the
+        outputs are the same as stepping through them. The fire hazard layer catches up on
+        the next step.
+        :return: The number of steps skipped.
+        :rtype: int
+        """
+
+        scheduler = self.resident_engine if self.resident_engine is not None else self.resident_scheduler
+        next_time = scheduler.next_event_time()
+        if next_time is not None and self.rerouter is not None:
+            # Closing a road can reroute a waiting resident
+            next_time = min(next_time, self.road_network.next_closure_time())
+        if next_time is None or np.isinf(next_time):
+            return 0
+        last_step = self.get_step_at(next_time) - 1
+        if self.max_steps is not None:
+            last_step = min(last_step, self.max_steps)
+        start = self.steps
+        for step in range(start + 1, last_step + 1):
+            self.steps = step
+            self.time_elapsed = self.steps * self.step_interval
+            self.datacollector.collect(self)
+            if self.recorder is not None:
+                self.recorder.record(self, idle=True)
+        return max(last_step - start, 0)
+
+    def get_resident_ids(self):
+        # The unique ids of the residents, in the order of get_status_codes
+        residents = self.resident_engine.residents if self.resident_engine is not None else self.agents_by_type[Resident]
+        return np.array([agent.unique_id for agent in residents], dtype=np.int64)
+
+    def get_status_codes(self):
+        # The status code of each resident, see engine.STATUS_NAMES
+        if self.resident_engine is not None:
+            return self.resident_engine.status
+        return np.array([STATUS_CODES[status] for status in self.agents_by_type[Resident].get("status")], dtype=np.int8)
+
+    def update_status(self, resident, old_status, new_status):
+        # Move a resident between the status counters, old_status is None for a new resident
+        if old_status is not None:
+            self.status_counts[old_status] -= 1
+            self.residents_by_status[old_status].discard(resident)
+        self.status_counts[new_status] += 1
+        self.residents_by_status[new_status].add(resident)
 
     def get_statistics(self):
-        status = self.agents_by_type[Resident].get("status")
-        return pd.Series(status).value_counts()
+        # The number of residents in each status, for the statuses with residents
+        return pd.Series({status: count for status, count in self.status_counts.items() if count > 0}, dtype=int)
 
     def step(self):
+        profiler = self.profiler
+        if profiler is not None:
+            profiler.begin_step(self.steps)
 
         self.time_elapsed = self.steps * self.step_interval
 
-        self.agents_by_type[FireHazardCell].do("step")
-        self.agents_by_type[FireHazard].do("step")
-        self.agents_by_type[Resident].do("step")
+        with phase(profiler, "fire"):
+            self.fire_hazard_layer.step()
+
+        if self.rerouter is not None:
+            with phase(profiler, "reroute"):
+                self.rerouter.step()
+
+        with phase(profiler, "residents"):
+            if self.resident_engine is not None:
+                self.resident_engine.step()
+            else:
+                self.resident_scheduler.step()
+        if self.resident_engine is not None and self.sync_agents:
+            with phase(profiler, "sync"):
+                self.resident_engine.sync_agents()
 
         # Collect data
-        self.n_dead = self.get_statistics().get("dead", 0)
-        self.n_evacuated = self.get_statistics().get("evacuated", 0)
+        self.n_dead = self.status_counts["dead"]
+        self.n_evacuated = self.status_counts["evacuated"]
+        self.n_stranded = self.status_counts["stranded"]
 
-        self.datacollector.collect(self)
+        with phase(profiler, "collect"):
+            self.datacollector.collect(self)
 
-        # Stop the model if all agents are evacuated
-        if self.n_dead + self.n_evacuated < len(self.agents_by_type[Resident]):
+        # Stop the model if all agents are evacuated (or dead, or stranded)
+        if self.n_dead + self.n_evacuated + self.n_stranded < self.num_residents:
             # print("Step: ", self.steps)
             pass
         else:
             self.running = False
 
+        if self.recorder is not None:
+            with phase(profiler, "record"):
+                self.recorder.record(self)
+
+        if self.fast_forward and self.running:
+            with phase(profiler, "fast_forward"):
+                self.skip_idle_steps()
+
+        if profiler is not None:
+            profiler.end_step()
+
 def get_count_agent_evacuated(model):
 
     n = 0
@@ -193,27 +391,10 @@ def simualtion():
         "Rtau": [90]
     }
 
-    # Create a list to store the results
-    results = []
-
-    for num_residents in scenarios["num_residents"]:
-        for Rtau in scenarios["Rtau"]:
-            model = EvacuationModel(num_residents=num_residents, Rtau=Rtau)
-            while model.running:
-                model.step()
-                print(model.steps)
-            print("Simulation completed for num_residents: ", num_residents, "Rtau: ", Rtau)
-            results.append({
-                "num_residents": num_residents,
-                "Rtau": Rtau,
-                "n_evacuated": model.n_evacuated,
-                "n_dead": model.n_dead,
-                "evacuation_time": model.evacuation_time_list
-            })
-
-    # Save the results to a csv file
-    df = pd.DataFrame(results)
-    df.to_csv("siumlation_results.csv", index=False)
+    # Run the scenarios in parallel, the results are appended to the csv file as runs finish
+    # and the runs already in it are skipped
+    from batch import run_batch, scenario_grid
+    run_batch(scenario_grid(scenarios, engine="vectorized", sync_agents=False), results_file="siumlation_results.csv")
 
 if __name__ == "__main__":
     # demo()
@@ -0,0 +1,140 @@
+import hashlib
+import json
+import os
+import pickle
+import shutil
+import tempfile
+from collections import OrderedDict
+import numpy as np
+import shapely
+
+# Bump when the layout or the content of the cache entries changes
+CACHE_VERSION = 2
+
+def hash_network_inputs(geo_series, **params):
+    """
+    Hash the geometries, the CRS and the build parameters of a road network.
+    :param geo_series: The road network geometries.
+    :type geo_series: gpd.GeoSeries
+    :param params: The build parameters, must be JSON serializable.
+    :return: The hex digest used as the cache key.
+    :rtype: str
+    """
+
+    digest = hashlib.sha256()
+    digest.update(f"version={CACHE_VERSION}".encode())
+    crs = getattr(geo_series, "crs", None)
+    digest.update(f"crs={crs.to_string() if crs is not None else None}".encode())
+    digest.update(json.dumps(params, sort_keys=True).encode())
+    for wkb in shapely.to_wkb(np.asarray(geo_series, dtype=object)):
+        digest.update(b"" if wkb is None else wkb)
+    return digest.hexdigest()
+
+def hash_array(values):
+    return hashlib.sha256(np.ascontiguousarray(values).tobytes()).hexdigest()
+
+class NetworkCache:
+    """
+    A cache entry addressed by the hash of the network inputs.
+
+    Every file is written to a temporary file and moved into place, so concurrent
+    readers never see a partial file. An entry is only valid once its manifest,
+    written last, lists files that all exist and matches the cache version.
+    """
+
+    def __init__(self, cache_dir, key, max_path_entries=100000):
+        self.cache_dir = cache_dir
+        self.key = key
+        self.entry_dir = os.path.join(cache_dir, f"network-{key[:32]}")
+        self.max_path_entries = max_path_entries
+
+    def path(self, name):
+        return os.path.join(self.entry_dir, name)
+
+    def is_valid(self, names):
+        manifest = self.load_manifest()
+        return (
+            manifest is not None and
+            manifest.get("version") == CACHE_VERSION and
+            manifest.get("key") == self.key and
+            set(names) <= set(manifest.get("files", [])) and
+            all(os.path.exists(self.path(name)) for name in names)
+        )
+
+    def load_manifest(self):
+        try:
+            with open(self.path("manifest.json")) as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return None
+
+    def write(self, name, dump):
+        """
+        Atomically write a file of the entry.
+        :param name: The file name, relative to the entry.
+        :type name: str
+        :param dump: A function writing the content to a binary file object.
+        :type dump: callable
+        """
+
+        path = self.path(name)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path), prefix=f".{os.path.basename(path)}.", suffix=".tmp")
+        try:
+            with os.fdopen(fd, "wb") as f:
+                dump(f)
+                f.flush()
+                os.fsync(f.fileno())
+            os.replace(tmp_path, path)
+        except BaseException:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+            raise
+
+    def write_manifest(self, names):
+        manifest = {"version": CACHE_VERSION, "key": self.key, "files": sorted(names)}
+        self.write("manifest.json", lambda f: f.write(json.dumps(manifest, indent=2).encode()))
+
+    def save_pickle(self, name, obj):
+        self.write(name, lambda f: pickle.dump(obj, f, protocol=pickle.HIGHEST_PROTOCOL))
+
+    def load_pickle(self, name):
+        with open(self.path(name), "rb") as f:
+            return pickle.load(f)
+
+    def save_array(self, name, values):
+        self.write(name, lambda f: np.save(f, values))
+
+    def load_array(self, name, mmap_mode=None):
+        return np.load(self.path(name), mmap_mode=mmap_mode)
+
+    def save_paths(self, paths):
+        """
+        Merge path entries into the cached ones and keep at most `max_path_entries`,
+        evicting the least recently used. `paths` is ordered from least to most recently used.
+        """
+
+        merged = self.load_paths()
+        for key, path in paths.items():
+            merged.pop(key, None)
+            merged[key] = path
+        while len(merged) > self.max_path_entries:
+            merged.popitem(last=False)
+        self.save_pickle("paths.pkl", merged)
+
+    def load_paths(self):
+        try:
+            return OrderedDict(self.load_pickle("paths.pkl"))
+        except (OSError, EOFError, pickle.UnpicklingError):
+            return OrderedDict()
+
+    def clear(self):
+        shutil.rmtree(self.entry_dir, ignore_errors=True)
+
+    @staticmethod
+    def clear_all(cache_dir):
+        if not os.path.isdir(cache_dir):
+            return
+        for name in os.listdir(cache_dir):
+            if name.startswith("network-"):
+                shutil.rmtree(os.path.join(cache_dir, name), ignore_errors=True)
@@ -0,0 +1,138 @@
+import contextlib
+import json
+import os
+import time
+from collections import defaultdict
+import pandas as pd
+
+# The phase of a model without a profiler, shared so that an unprofiled phase costs one call
+NULL_PHASE = contextlib.nullcontext()
+
+def phase(profiler, name):
+    """
+    Time a phase of the model step with the profiler of the model, if any:
+
+        with phase(self.model.profiler, "leaders"):
+            ...
+
+    :param profiler: The profiler, or None when profiling is off.
+    :type profiler: Profiler
+    :param name: The name of the phase, nested in the enclosing phase.
+    :type name: str
+    :return: A context manager timing the phase.
+    """
+
+    return NULL_PHASE if profiler is None else profiler.phase(name)
+
+class Phase:
+    # A phase being timed, see Profiler.phase
+    __slots__ = ("profiler", "name", "path", "start")
+
+    def __init__(self, profiler, name):
+        self.profiler = profiler
+        self.name = name
+
+    def __enter__(self):
+        stack = self.profiler.stack
+        self.path = f"{stack[-1]}/{self.name}" if stack else self.name
+        stack.append(self.path)
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc_info):
+        end = time.perf_counter()
+        self.profiler.stack.pop()
+        self.profiler.add(self.name, self.path, self.start, end)
+
+class Profiler:
+    """
+    Wall time and number of calls of each phase of the model steps. Pass a profiler to
+    EvacuationModel(profiler=...) to time:
+
+    - `fire`: the fire hazard layer step, and `polygonize` when the burnt area is drawn,
+    - `residents`: the resident engine or scheduler step, with sub-phases such as
+      `leaders`, `car_following` and `move`,
+    - `reroute` (with rerouting on), `sync`, `collect`, `record` and `fast_forward`,
+    - `step`: the whole step.
+
+    Nested phases are named by their path, such as `residents/step/leaders`. The times
+    are kept per step, see `get_step_table` and `get_summary`, and every call is also
+    kept for `write_chrome_trace` when `trace` is True.
+    """
+
+    def __init__(self, trace=False):
+        self.trace = trace
+        self.stack = []  # paths of the phases being timed
+        self.origin = time.perf_counter()
+        self.step = None  # the step being timed
+        self.step_start = None
+        self.step_times = defaultdict(float)  # phase path -> seconds in the current step
+        self.step_calls = defaultdict(int)  # phase path -> calls in the current step
+        self.rows = []  # (step, phase, calls, seconds) of the finished steps
+        self.events = []  # Chrome trace events, when tracing
+
+    def phase(self, name):
+        return Phase(self, name)
+
+    def add(self, name, path, start, end):
+        self.step_times[path] += end - start
+        self.step_calls[path] += 1
+        if self.trace:
+            self.events.append({
+                "name": name,
+                "cat": path,
+                "ph": "X",
+                "ts": (start - self.origin) * 1e6,
+                "dur": (end - start) * 1e6,
+                "pid": os.getpid(),
+                "tid": 0,
+                "args": {"step": self.step},
+            })
+
+    def begin_step(self, step):
+        """Start timing a step, called by the model."""
+
+        self.step = step
+        self.step_start = time.perf_counter()
+
+    def end_step(self):
+        """Finish timing a step, called by the model."""
+
+        self.add("step", "step", self.step_start, time.perf_counter())
+        for path, seconds in self.step_times.items():
+            self.rows.append((self.step, path, self.step_calls[path], seconds))
+        self.step_times.clear()
+        self.step_calls.clear()
+
+    def get_step_table(self):
+        """
+        The time of each phase in each step.
+        :return: The step, phase, number of calls and seconds of each phase of each step.
+        :rtype: pd.DataFrame
+        """
+
+        return pd.DataFrame(self.rows, columns=["step", "phase", "calls", "seconds"])
+
+    def get_summary(self):
+        """
+        The time of each phase over all the steps, slowest first.
+        :return: The number of calls, total seconds, mean milliseconds per call and share of
+            the step time of each phase.
+        :rtype: pd.DataFrame
+        """
+
+        table = self.get_step_table().groupby("phase")[["calls", "seconds"]].sum()
+        table["ms_per_call"] = table["seconds"] / table["calls"] * 1000
+        table["share"] = table["seconds"] / table["seconds"].get("step", float("nan"))
+        return table.sort_values("seconds", ascending=False)
+
+    def write_chrome_trace(self, path):
+        """
+        Write the timed calls as a Chrome trace (chrome://tracing or https://ui.perfetto.dev).
+        Requires a profiler created with trace=True.
+        """
+
+        if not self.trace:
+            raise ValueError("The profiler does not keep a trace, create it with Profiler(trace=True)")
+        with open(path, "w") as f:
+            json.dump({"traceEvents": self.events, "displayTimeUnit": "ms"}, f)
@@ -0,0 +1,130 @@
+import numpy as np
+from engine import STATUS_NAMES, EVACUATED, DEAD, STRANDED
+
+try:
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+except ImportError:  # pyarrow is optional, only needed to record
+    pa = None
+    pq = None
+
+STEP_SCHEMA = [
+    ("step", "int64"),
+    ("time_elapsed", "float64"),
+    *[(f"n_{name}", "int64") for name in STATUS_NAMES],
+]
+EVENT_SCHEMA = [
+    ("step", "int64"),
+    ("time_elapsed", "float64"),
+    ("resident_id", "int64"),
+    ("event", "string"),
+]
+
+class ColumnWriter:
+    """
+    Buffer rows of a table column by column, and write them to a Parquet or Arrow IPC
+    file as one record batch every `chunk_size` rows.
+    """
+
+    def __init__(self, path, schema, file_format="parquet", chunk_size=65536):
+        self.path = path
+        self.schema = pa.schema([(name, getattr(pa, dtype)()) for name, dtype in schema])
+        self.chunk_size = chunk_size
+        if file_format == "parquet":
+            self.writer = pq.ParquetWriter(path, self.schema)
+        elif file_format == "arrow":
+            self.writer = pa.ipc.new_file(path, self.schema)
+        else:
+            raise ValueError(f"Unknown file format: {file_format}")
+        self.columns = {name: [] for name in self.schema.names}
+        self.n_rows = 0
+
+    def append(self, **columns):
+        # Append rows, every column is given as an array (or a scalar for a single row)
+        n = 0
+        for name, values in columns.items():
+            values = np.atleast_1d(values)
+            self.columns[name].append(values)
+            n = len(values)
+        self.n_rows += n
+        if self.n_rows >= self.chunk_size:
+            self.flush()
+
+    def flush(self):
+        if self.n_rows == 0:
+            return
+        arrays = [pa.array(np.concatenate(self.columns[field.name]), type=field.type) for field in self.schema]
+        self.writer.write_batch(pa.RecordBatch.from_arrays(arrays, schema=self.schema))
+        self.columns = {name: [] for name in self.schema.names}
+        self.n_rows = 0
+
+    def close(self):
+        self.flush()
+        self.writer.close()
+
+class Recorder:
+    """
+    Stream the outputs of a model run to two columnar files, instead of keeping them in memory:
+
+    - `<path>_steps.<ext>`: the number of residents in each status, every `sample_interval` steps.
+    - `<path>_events.<ext>`: one row per resident evacuated, dead or stranded, at the step it happened
+      (the evacuation time in minutes is `time_elapsed / 60`).
+
+    Rows are buffered and written in chunks of `chunk_size` rows, which caps the memory used.
+    Pass the recorder to EvacuationModel(recorder=...), which records every step, and close
+    it (or use it as a context manager) at the end of the run to complete the files.
+    Requires pyarrow.
+    """
+
+    def __init__(self, path, sample_interval=1, chunk_size=65536, file_format="parquet"):
+        if pa is None:
+            raise ImportError("Recording requires pyarrow, install it with `pip install pyarrow`")
+        extension = "parquet" if file_format == "parquet" else "arrow"
+        self.sample_interval = sample_interval
+        self.steps = ColumnWriter(f"{path}_steps.{extension}", STEP_SCHEMA, file_format, chunk_size)
+        self.events = ColumnWriter(f"{path}_events.{extension}", EVENT_SCHEMA, file_format, chunk_size)
+        self.resident_ids = None
+        self.status = None
+        self.stopped = False  # the step the model stopped at is always sampled, once
+
+    def record(self, model, idle=False):
+        """
+        Record the state of the model after a step, called by the model.
+        :param idle: True for a step skipped by a fast forward, where no status changed.
+        """
+
+        status = self.status if idle else model.get_status_codes()
+        if self.resident_ids is None:
+            self.resident_ids = model.get_resident_ids()
+            self.status = np.zeros_like(status)
+
+        # Residents evacuated, dead or stranded since the last step
+        changed = np.flatnonzero((status != self.status) & np.isin(status, (EVACUATED, DEAD, STRANDED)))
+        if changed.size > 0:
+            self.events.append(
+                step=np.full(changed.size, model.steps),
+                time_elapsed=np.full(changed.size, float(model.time_elapsed)),
+                resident_id=self.resident_ids[changed],
+                event=STATUS_NAMES[status[changed]],
+            )
+        self.status = status.copy()
+
+        stopping = not model.running and not self.stopped
+        self.stopped = not model.running
+        if model.steps % self.sample_interval == 0 or stopping:
+            counts = np.bincount(status, minlength=len(STATUS_NAMES))
+            self.steps.append(
+                step=model.steps,
+                time_elapsed=float(model.time_elapsed),
+                **{f"n_{name}": counts[code] for code, name in enumerate(STATUS_NAMES)},
+            )
+
+    def close(self):
+        self.steps.close()
+        self.events.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
@@ -0,0 +1,193 @@
+import csv
+import math
+import time
+from concurrent.futures import as_completed
+import numpy as np
+from scipy import stats
+from batch import prepare, process_pool
+from model import EvacuationModel
+
+def replicate_seeds(seed, n_scenarios, replicates):
+    """
+    Spawn an independent seed sequence for every replicate of every scenario. The
+    streams only depend on the root seed and on their position, not on the order the
+    runs are scheduled in, so a batch can be split across workers and reproduced.
+    :param seed: The root seed, fresh entropy from the operating system if None.
+    :type seed: int
+    :return: The root seed sequence and the seed sequences of each scenario's replicates.
+    :rtype: tuple[np.random.SeedSequence, list[list[np.random.SeedSequence]]]
+    """
+
+    root = np.random.SeedSequence(seed)
+    return root, [scenario.spawn(replicates) for scenario in root.spawn(n_scenarios)]
+
+def run_replicate(params, seed_sequence, max_steps=None):
+    """
+    Run one replicate and summarize it, without keeping its history.
+    :param params: The EvacuationModel parameters.
+    :type params: dict
+    :param seed_sequence: The seed of the replicate random number generator.
+    :type seed_sequence: np.random.SeedSequence
+    :param max_steps: The maximum number of steps, unbounded if None.
+    :type max_steps: int
+    :return: The number of residents, dead, evacuated and stranded residents, the number of steps
+        and the count of evacuated residents per evacuation time in seconds.
+    :rtype: dict
+    """
+
+    model = EvacuationModel(**params, rng=seed_sequence)
+    model.max_steps = max_steps
+    while model.running and (max_steps is None or model.steps < max_steps):
+        model.step()
+    seconds = np.rint(np.asarray(model.evacuation_time_list, dtype=float) * 60).astype(np.int64)
+    return {
+        "n_residents": model.num_residents,
+        "n_dead": int(model.n_dead),
+        "n_evacuated": int(model.n_evacuated),
+        "n_stranded": int(model.n_stranded),
+        "steps": model.steps,
+        "time_counts": np.bincount(seconds),
+    }
+
+class RunningMoments:
+    """Running mean and variance of a value, with Welford's algorithm."""
+
+    def __init__(self):
+        self.count = 0
+        self.mean = 0.0
+        self.m2 = 0.0
+
+    def add(self, value):
+        self.count += 1
+        delta = value - self.mean
+        self.mean += delta / self.count
+        self.m2 += delta * (value - self.mean)
+
+    def summary(self, confidence=0.95):
+        # The mean, standard deviation and the t confidence interval of the mean
+        if self.count == 0:
+            return {"mean": math.nan, "std": math.nan, "ci_low": math.nan, "ci_high": math.nan}
+        if self.count == 1:
+            return {"mean": self.mean, "std": math.nan, "ci_low": math.nan, "ci_high": math.nan}
+        std = math.sqrt(self.m2 / (self.count - 1))
+        half_width = float(stats.t.ppf((1 + confidence) / 2, self.count - 1)) * std / math.sqrt(self.count)
+        return {"mean": self.mean, "std": std, "ci_low": self.mean - half_width, "ci_high": self.mean + half_width}
+
+class ReplicateStats:
+    """
+    Statistics of the replicates of one scenario, updated as each replicate finishes.
+    The casualty rate, the evacuation rate and the mean evacuation time are aggregated
+    per replicate (for their confidence intervals), and the evacuation times of all the
+    replicates are pooled in a histogram with one second bins (for their quantiles).
+
+    Replicates are folded in in replicate order, whatever order they finish in, so the
+    statistics are reproducible to the last bit. Only the summaries of replicates that
+    finished ahead of an earlier one are held.
+    """
+
+    def __init__(self):
+        self.n_runs = 0
+        self.pending = {}  # replicate index -> summary, for replicates finished out of order
+        self.casualty_rate = RunningMoments()
+        self.evacuation_rate = RunningMoments()
+        self.stranded_rate = RunningMoments()
+        self.mean_evacuation_time = RunningMoments()  # in minutes, over the replicates with evacuees
+        self.time_counts = np.zeros(0, dtype=np.int64)  # evacuated residents per evacuation time in seconds
+
+    def add(self, replicate, result):
+        self.pending[replicate] = result
+        while self.n_runs in self.pending:
+            self._fold(self.pending.pop(self.n_runs))
+
+    def _fold(self, result):
+        self.n_runs += 1
+        n_residents = max(result["n_residents"], 1)
+        self.casualty_rate.add(result["n_dead"] / n_residents)
+        self.evacuation_rate.add(result["n_evacuated"] / n_residents)
+        self.stranded_rate.add(result["n_stranded"] / n_residents)
+
+        counts = result["time_counts"]
+        if counts.sum() > 0:
+            self.mean_evacuation_time.add(float(np.dot(counts, np.arange(len(counts))) / counts.sum() / 60))
+        if len(counts) > len(self.time_counts):
+            self.time_counts = np.pad(self.time_counts, (0, len(counts) - len(self.time_counts)))
+        self.time_counts[:len(counts)] += counts
+
+    def evacuation_time_quantiles(self, quantiles):
+        # Quantiles of the pooled evacuation times in minutes, at one second resolution
+        cumulative = np.cumsum(self.time_counts)
+        total = cumulative[-1] if len(cumulative) else 0
+        if total == 0:
+            return [math.nan for _ in quantiles]
+        return [int(np.searchsorted(cumulative, max(q * total, 1))) / 60 for q in quantiles]
+
+    def summary(self, quantiles=(0.05, 0.5, 0.95), confidence=0.95):
+        row = {"n_runs": self.n_runs}
+        for name in ("casualty_rate", "evacuation_rate", "stranded_rate", "mean_evacuation_time"):
+            for stat, value in getattr(self, name).summary(confidence).items():
+                row[f"{name}_{stat}"] = value
+        for q, value in zip(quantiles, self.evacuation_time_quantiles(quantiles)):
+            row[f"evacuation_time_q{round(q * 100):02d}"] = value
+        return row
+
+def run_replicates(scenarios, replicates=30, seed=None, results_file=None, max_workers=None, max_steps=None,
+                   quantiles=(0.05, 0.5, 0.95), confidence=0.95):
+    """
+    Run `replicates` independently seeded replicates of each scenario in parallel over
+    a process pool, aggregating the statistics of each scenario as its replicates finish.
+    :param scenarios: The EvacuationModel parameters of each scenario, see batch.scenario_grid.
+    :type scenarios: list[dict]
+    :param replicates: The number of replicates per scenario.
+    :type replicates: int
+    :param seed: The root seed, the same seed gives the same results. Drawn from the
+        operating system if None, it is reported in the results either way.
+    :type seed: int
+    :param results_file: A CSV file a row is appended to as each scenario completes, optional.
+    :type results_file: str
+    :param max_workers: The number of worker processes, all the cores if None.
+    :type max_workers: int
+    :param max_steps: The maximum number of steps of each run, unbounded if None.
+    :type max_steps: int
+    :return: The parameters and the aggregated statistics of each scenario.
+    :rtype: list[dict]
+    """
+
+    root, seeds = replicate_seeds(seed, len(scenarios), replicates)
+    replicate_stats = [ReplicateStats() for _ in scenarios]
+    rows = [None] * len(scenarios)
+    print(f"Running {replicates} replicates of {len(scenarios)} scenarios, seed {root.entropy}")
+
+    start = time.perf_counter()
+    prepare(scenarios)
+    with process_pool(max_workers) as executor:
+        futures = {
+            executor.submit(run_replicate, params, seeds[i][r], max_steps): (i, r)
+            for i, params in enumerate(scenarios) for r in range(replicates)
+        }
+        for done, future in enumerate(as_completed(futures), start=1):
+            i, r = futures[future]
+            replicate_stats[i].add(r, future.result())
+            if replicate_stats[i].n_runs < replicates:
+                continue
+
+            # All the replicates of the scenario are done
+            rows[i] = {**scenarios[i], "seed": root.entropy, **replicate_stats[i].summary(quantiles, confidence)}
+            print(
+                f"Scenario {i + 1}/{len(scenarios)} completed after {done} runs, {time.perf_counter() - start:.1f} s: "
+                f"casualty rate {rows[i]['casualty_rate_mean']:.2%}, "
+                f"mean evacuation time {rows[i]['mean_evacuation_time_mean']:.2f} min"
+            )
+            if results_file is not None:
+                append_row(results_file, rows[i])
+    return rows
+
+def append_row(results_file, row):
+    with open(results_file, "a", newline="") as f:
+        writer = csv.DictWriter(f, fieldnames=list(row))
+        if f.tell() == 0:
+            writer.writeheader()
+        writer.writerow(row)
+
+if __name__ == "__main__":
+    from batch import scenario_grid
+    run_replicates(scenario_grid({"num_residents": [500], "Rtau": [45, 90]}, engine="vectorized", sync_agents=False), replicates=30)
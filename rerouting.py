@@ -0,0 +1,115 @@
+import numpy as np
+from agents import Shelter
+from engine import WAITING, EVACUATING
+
+class FireRerouter:
+    """
+    Reroute the residents around the road edges closed by the fire, for both engines:
+
+    - the road network precomputes the time each edge burns from the fire arrival times,
+      and closes the edges in that order, repairing the shelter table around them,
+    - only the waiting and evacuating residents whose remaining route crosses a newly
+      closed edge get rerouted, found through an index of the routes by edge,
+    - a rerouted resident keeps going to the end of its current edge, or turns back when
+      that edge is closed or the way back is shorter, then follows the shelter table.
+
+    A resident with no shelter reachable keeps its route.
+    """
+
+    def __init__(self, model, residents):
+        self.model = model
+        self.residents = list(residents)
+        self.shelters = list(model.agents_by_type[Shelter])
+        self.network = model.road_network
+        self.network.compute_edge_burn_times(model.fire_hazard_layer.fire_arrival_seconds, model.transform)
+        self.n_rerouted = 0
+
+        # Residents by the edges of their routes, the entries of replaced routes are left
+        # behind and filtered out when their edges close
+        self.edge_residents = {}
+        for i, agent in enumerate(self.residents):
+            self.index_route(i, agent.route_edges)
+
+    def index_route(self, i, route_edges):
+        for edge in np.unique(route_edges).tolist():
+            self.edge_residents.setdefault(edge, set()).add(i)
+
+    def step(self):
+        """
+        Close the edges burnt by the current time and reroute the residents crossing them.
+        :return: The number of residents rerouted.
+        :rtype: int
+        """
+
+        closed = self.network.close_edges(self.model.time_elapsed)
+        if closed.size == 0:
+            return 0
+        candidates = set()
+        for edge in closed.tolist():
+            candidates.update(self.edge_residents.get(edge, ()))
+
+        rows, paths, progress = [], [], []
+        for i in sorted(candidates):
+            route = self.get_route(i)
+            if route is None or not np.isin(route[0][route[3]:], closed).any():
+                continue
+            detour = self.get_detour(*route)
+            if detour is not None:
+                rows.append(i)
+                paths.append(detour[1])
+                progress.append(detour[2])
+                if self.model.resident_engine is None:
+                    self.residents[i].set_route(detour[1], detour[2], self.shelters[detour[0]])
+
+        if rows and self.model.resident_engine is not None:
+            self.model.resident_engine.set_routes(rows, paths, progress)
+        for i in rows:
+            self.index_route(i, self.get_route(i)[0])
+        self.n_rerouted += len(rows)
+        return len(rows)
+
+    def get_route(self, i):
+        # The route edges, cumulative distances, progress and edge index of a resident still
+        # on its way, None for the others
+        engine = self.model.resident_engine
+        if engine is not None:
+            if engine.status[i] not in (WAITING, EVACUATING) or engine.distance_to_dest[i] < 0:
+                return None
+            start, cum_start, length = engine.route_start[i], engine.cum_start[i], engine.route_length[i]
+            route = (
+                engine.route_edges[start:start + length], engine.route_cum[cum_start:cum_start + length + 1],
+                float(engine.progress[i]), int(engine.path_index[i])
+            )
+        else:
+            agent = self.residents[i]
+            if agent.status not in ("waiting", "evacuating") or agent.distance_to_dest < 0:
+                return None
+            route = (agent.route_edges, agent.route_cum, float(agent.path_progress), int(agent.path_index))
+        if len(route[0]) == 0 or route[2] >= route[1][-1]:
+            return None
+        return route
+
+    def get_detour(self, route_edges, route_cum, progress, path_index):
+        """
+        Get the shortest way to a shelter from a position on a route, ahead along the current
+        edge or back, over the open edges.
+        :return: The index of the shelter, the path from the start of the edge the resident
+            then drives along, and the progress on it, None if no shelter is reachable.
+        :rtype: tuple
+        """
+
+        network = self.network
+        start, end = network.get_edge_nodes(route_edges[path_index])
+        length = route_cum[path_index + 1] - route_cum[path_index]
+        offset = min(max(progress - route_cum[path_index], 0.0), length)
+        distance = network.shelter_table["distance"]
+
+        # Ahead, unless the edge is closed, or back
+        options = [(offset + distance[start], end, start, length - offset)]
+        if not network.is_edge_closed(start, end):
+            options.insert(0, (length - offset + distance[end], start, end, offset))
+        cost, first, second, edge_progress = min(options, key=lambda option: option[0])
+        if not np.isfinite(cost):
+            return None
+        shelter_index, path = network.get_shelter_path_from([first, second])
+        return shelter_index, path, edge_progress
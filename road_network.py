@@ -1,57 +1,128 @@
 import networkx as nx
+import numpy as np
+import bisect
+import heapq
 import geopandas as gpd
 from shapely.geometry import LineString, Point
 from scipy.spatial import KDTree
-import pickle
+from scipy import sparse
+from scipy.sparse import csgraph
+import shapely
+from collections import OrderedDict
+from network_cache import NetworkCache, hash_network_inputs, hash_array
 import os
-import matplotlib.pyplot as plt
 import logging
 import time
 
-# Set up logging
-log_dir = "log"
-os.makedirs(log_dir, exist_ok=True)
-logging.basicConfig(filename=os.path.join(log_dir, 'road_network.log'), level=logging.WARNING,
-                    format='%(asctime)s - %(levelname)s - %(message)s')
+logger = logging.getLogger(__name__)
 
-# Set matplotlib logger to WARNING level to ignore debug messages
-matplotlib_logger = logging.getLogger('matplotlib')
-matplotlib_logger.setLevel(logging.WARNING)
+def setup_logging(log_dir="log"):
+    """
+    Write the warnings to `<log_dir>/road_network.log`. Called by the entry points
+    (the app and the demos), importing the module has no side effect.
+    """
+
+    os.makedirs(log_dir, exist_ok=True)
+    logging.basicConfig(filename=os.path.join(log_dir, 'road_network.log'), level=logging.WARNING,
+                        format='%(asctime)s - %(levelname)s - %(message)s')
+
+    # Set matplotlib logger to WARNING level to ignore debug messages
+    matplotlib_logger = logging.getLogger('matplotlib')
+    matplotlib_logger.setLevel(logging.WARNING)
 
 class RoadNetwork:
-    def __init__(self, geo_series: gpd.GeoSeries = None, cache_dir="cache", use_cache=True):
-        self.graph = nx.Graph()
+    # The files of a cache entry
+    # Flat arrays: node coordinates in node id order and the CSR adjacency matrix of edge lengths
+    cache_files = ('nodes.npy', 'indptr.npy', 'indices.npy', 'weights.npy')
+
+    def __init__(self, geo_series: gpd.GeoSeries = None, cache_dir="cache", use_cache=True, max_cached_paths=100000):
+        self._graph = nx.Graph()
+        self._graph_adjacency = None  # cached adjacency matrix the graph is built from on first use
+        self._adjacency = None  # adjacency matrix of the road closures, see _get_adjacency
         self.nodes = []
         self.kdtree = None
         self.cache_dir = cache_dir
         self.use_cache = use_cache
-        self.shortest_paths = {}
+        self.max_cached_paths = max_cached_paths
+        self.shortest_paths = OrderedDict()  # (start, end) -> path, least recently used first
+        self.shelter_trees = {}  # shelter node -> (predecessors, distances) of its shortest path tree
+        self.shelter_table = None  # per node nearest shelter, distance and next hop, see build_shelter_table
+
+        # Road closures, see compute_edge_burn_times and close_edges
+        self.edge_burn_times = None  # burn time in seconds of each adjacency entry
+        self.edge_closed = None  # closed adjacency entries
+        self._closure_order = None  # adjacency entries by burn time
+        self._closure_times = None  # their burn times
+        self._closure_pointer = 0  # number of entries of _closure_order closed
+        self._tree_children = None  # per node, the nodes whose next hop it is
+
+        # Vehicles registered on the directed edges they occupy
+        self.edge_vehicles = {}  # edge id -> sorted list of (offset, vehicle id)
+        self.vehicles = {}  # vehicle id -> (edge id, offset, vehicle)
+        
+
+        # The cache entry is addressed by the hash of the geometries, their CRS and the backend
+        self.cache = None
+        if geo_series is not None:
+            self.cache = NetworkCache(
+                cache_dir, hash_network_inputs(geo_series, backend=type(self).__name__), max_cached_paths
+            )
         
         if use_cache and self._cache_exists():
             self.load_from_cache()
         elif geo_series is not None:
-            self.clear_cache()
             self._build_graph(geo_series)
+            self._index_nodes()
             self.kdtree = KDTree(self.nodes)
             self.save_to_cache()
+        else:
+            self._index_nodes()
+
+    @property
+    def graph(self):
+        if self._graph_adjacency is not None:
+            # Each undirected edge is stored in both directions
+            upper = sparse.triu(self._graph_adjacency, k=1).tocoo()
+            self._graph.add_nodes_from(self.node_list)
+            self._graph.add_weighted_edges_from(
+                (self.node_list[u], self.node_list[v], w) for u, v, w in zip(upper.row.tolist(), upper.col.tolist(), upper.data.tolist())
+            )
+            self._graph_adjacency = None
+        return self._graph
+
+    @graph.setter
+    def graph(self, graph):
+        self._graph = graph
+        self._graph_adjacency = None
 
     def _cache_exists(self):
-        return (os.path.exists(os.path.join(self.cache_dir, 'nodes.pkl')) and
-                os.path.exists(os.path.join(self.cache_dir, 'edges.pkl')) and
-                os.path.exists(os.path.join(self.cache_dir, 'kdtree.pkl')) and
-                os.path.exists(os.path.join(self.cache_dir, 'shortest_paths.pkl')))
+        return self.cache is not None and self.cache.is_valid(self.cache_files)
 
     def _build_graph(self, geo_series: gpd.GeoSeries):
         for line in geo_series:
             if isinstance(line, LineString):
                 coords = list(line.coords)
-                self.nodes.extend(coords)
                 for i in range(len(coords) - 1):
                     start = coords[i]
                     end = coords[i + 1]
                     distance = LineString([start, end]).length
                     self.graph.add_edge(start, end, weight=distance)
 
+    def _index_nodes(self):
+        # Integer ids of the graph nodes, in coordinate order so they do not depend on how the graph was loaded
+        self.node_list = sorted(self.graph.nodes)
+        self.node_ids = {node: i for i, node in enumerate(self.node_list)}
+        self.nodes = self.node_list
+
+    def _num_nodes(self):
+        return len(self.node_list)
+
+    def _node_index(self, node):
+        return self.node_ids[node]
+
+    def _node_coords(self, ids):
+        return [self.node_list[i] for i in ids]
+
     def heuristic(self, n1, n2):
         # Using Euclidean distance as heuristic
         return LineString([n1, n2]).length
@@ -62,86 +133,637 @@ class RoadNetwork:
         return nearest_node
 
     def get_shortest_path(self, start_point, end_point):
-        logging.debug(f"Calculating shortest path from {start_point} to {end_point}")
+        logger.debug(f"Calculating shortest path from {start_point} to {end_point}")
         start_point = self.snap_to_network(start_point)
         end_point = self.snap_to_network(end_point)
         path_key = (start_point, end_point)
+
+        # Walk the shortest path tree if the end point has one
+        if end_point in self.shelter_trees:
+            return self._walk_shelter_tree(start_point, end_point)
         
         # Check if the path is already cached
         if path_key in self.shortest_paths:
-            logging.debug(f"Path retrieved from cache: {path_key}")
+            logger.debug(f"Path retrieved from cache: {path_key}")
+            self.shortest_paths.move_to_end(path_key)
             return self.shortest_paths[path_key]
         
         # Calculate the path if not cached
         try:
             path = nx.astar_path(self.graph, source=start_point, target=end_point, heuristic=self.heuristic, weight='weight')
-            self.shortest_paths[path_key] = path
+            self._cache_path(path_key, path)
             
-            logging.debug(f"Path calculated and cached: {path_key}")
+            logger.debug(f"Path calculated and cached: {path_key}")
                 
             return path
         except nx.NetworkXNoPath as e:
-            logging.warning(f"No path found from {start_point} to {end_point}: {e}")
+            logger.warning(f"No path found from {start_point} to {end_point}: {e}")
             return []
         except Exception as e:
-            logging.warning(f"An error occurred while calculating the shortest path: {e}")
+            logger.warning(f"An error occurred while calculating the shortest path: {e}")
+            return []
+
+    def _cache_path(self, path_key, path):
+        # Keep at most max_cached_paths paths, evicting the least recently used
+        self.shortest_paths[path_key] = path
+        while len(self.shortest_paths) > self.max_cached_paths:
+            self.shortest_paths.popitem(last=False)
+
+    def get_route_arrays(self, path):
+        """
+        Get the directed edge ids and the cumulative distance at each vertex of a path.
+        :param path: The path as a list of network nodes.
+        :type path: list
+        :return: An (n - 1,) array of edge ids and an (n,) array of cumulative distances.
+        :rtype: tuple
+        """
+
+        coords = np.asarray(path, dtype=float).reshape(-1, 2)
+        delta = np.diff(coords, axis=0)
+        cum = np.concatenate([[0.0], np.cumsum(np.sqrt(delta[:, 0] * delta[:, 0] + delta[:, 1] * delta[:, 1]))])
+        ids = np.array([self.node_ids[node] for node in path], dtype=np.int64)
+        edges = ids[:-1] * len(self.node_ids) + ids[1:]
+        return edges, cum
+
+    def register_vehicle(self, vehicle, vehicle_id, edge, offset):
+        """
+        Register a vehicle at `offset` along a directed edge, replacing its previous registration.
+        """
+
+        self.unregister_vehicle(vehicle_id)
+        bisect.insort(self.edge_vehicles.setdefault(edge, []), (offset, vehicle_id))
+        self.vehicles[vehicle_id] = (edge, offset, vehicle)
+
+    def unregister_vehicle(self, vehicle_id):
+        entry = self.vehicles.pop(vehicle_id, None)
+        if entry is None:
+            return
+        edge, offset, _ = entry
+        vehicles = self.edge_vehicles[edge]
+        del vehicles[bisect.bisect_left(vehicles, (offset, vehicle_id))]
+        if not vehicles:
+            del self.edge_vehicles[edge]
+
+    def is_registered(self, vehicle_id):
+        return vehicle_id in self.vehicles
+
+    def find_leader(self, vehicle_id, route_edges, route_cum, segment, progress, max_distance=100):
+        """
+        Find the vehicle ahead along a route: the next vehicle on the same edge, or the
+        first vehicle on the downstream edges of the route, within `max_distance`.
+        :param vehicle_id: The id of the following vehicle.
+        :type vehicle_id: int
+        :param route_edges: The edge ids of the route.
+        :type route_edges: np.ndarray
+        :param route_cum: The cumulative distance at each vertex of the route.
+        :type route_cum: np.ndarray
+        :param segment: The index of the route edge the vehicle is on.
+        :type segment: int
+        :param progress: The distance travelled along the route.
+        :type progress: float
+        :param max_distance: The look-ahead distance, defaults to 100.
+        :type max_distance: float, optional
+        :return: The vehicle ahead, or None.
+        """
+
+        offset = progress - route_cum[segment]
+        vehicles = self.edge_vehicles.get(route_edges[segment], ())
+        i = bisect.bisect_right(vehicles, (offset, vehicle_id))
+        if i < len(vehicles):
+            leader_offset, leader_id = vehicles[i]
+            return self.vehicles[leader_id][2] if leader_offset - offset <= max_distance else None
+
+        for j in range(segment + 1, len(route_edges)):
+            gap = route_cum[j] - progress
+            if gap > max_distance:
+                break
+            vehicles = self.edge_vehicles.get(route_edges[j])
+            if vehicles:
+                leader_offset, leader_id = vehicles[0]
+                return self.vehicles[leader_id][2] if gap + leader_offset <= max_distance else None
+        return None
+
+    def build_shelter_trees(self, end_points):
+        """
+        Build a shortest path tree rooted at each end point with one Dijkstra search.
+        The graph is undirected, so the tree of a shelter holds the shortest path from
+        every node to that shelter.
+        :param end_points: The shelter locations.
+        :type end_points: list of Point
+        """
+
+        for end_point in end_points:
+            end_node = self.snap_to_network((end_point.x, end_point.y))
+            if end_node not in self.shelter_trees:
+                self.shelter_trees[end_node] = nx.dijkstra_predecessor_and_distance(self.graph, end_node, weight='weight')
+
+    def _tree_arrays(self, end_node):
+        # The distance to the shelter and the next node towards it, per node id (-1 for none)
+        predecessors, distances = self.shelter_trees[end_node]
+        distance = np.full(self._num_nodes(), np.inf)
+        next_hop = np.full(self._num_nodes(), -1, dtype=np.int32)
+        for node, node_distance in distances.items():
+            i = self.node_ids[node]
+            distance[i] = node_distance
+            if predecessors[node]:
+                next_hop[i] = self.node_ids[predecessors[node][0]]
+        return distance, next_hop
+
+    def _walk_shelter_tree(self, start_node, end_node):
+        # Follow the predecessors from the start node up to the root of the tree
+        predecessors, distances = self.shelter_trees[end_node]
+        if start_node not in distances:
             return []
+        path = [start_node]
+        while path[-1] != end_node:
+            path.append(predecessors[path[-1]][0])
+        return path
+
+    def build_shelter_table(self, end_points):
+        """
+        Build the routing table of the end points: for every node, the index of the nearest
+        end point, the network distance to it and the next node on the way (-1 for none).
+        The table is saved to the cache as .npy files and loaded memory-mapped, so runs and
+        worker processes using the same network and shelters share it instead of rebuilding it.
+        :param end_points: The shelter locations.
+        :type end_points: list of Point
+        """
+
+        shelter_nodes = np.array(
+            [self._node_index(self.snap_to_network((end_point.x, end_point.y))) for end_point in end_points],
+            dtype=np.int64
+        )
+        if self.shelter_table is not None and np.array_equal(self.shelter_table["shelter_nodes"], shelter_nodes):
+            return
+        if self.use_cache:
+            self.shelter_table = self._load_shelter_table(shelter_nodes)
+            if self.shelter_table is not None:
+                return
+
+        # Keep, for every node, the nearest shelter (the first one on ties)
+        self.build_shelter_trees(end_points)
+        distances, next_hops = zip(*[
+            self._tree_arrays(self.snap_to_network((end_point.x, end_point.y))) for end_point in end_points
+        ])
+        distances = np.vstack(distances)
+        next_hops = np.vstack(next_hops)
+        nodes = np.arange(self._num_nodes())
+        nearest = np.argmin(distances, axis=0)
+        distance = distances[nearest, nodes]
+        reachable = np.isfinite(distance)
+        self.shelter_table = {
+            "shelter_nodes": shelter_nodes,
+            "shelter_index": np.where(reachable, nearest, -1).astype(np.int32),
+            "distance": distance,
+            "next_hop": np.where(reachable, next_hops[nearest, nodes], -1).astype(np.int32),
+        }
+        if self.use_cache:
+            self._save_shelter_table()
+            self.shelter_table = self._load_shelter_table(shelter_nodes)
+
+    def _shelter_table_dir(self, shelter_nodes):
+        # Tables of different shelter sets live side by side in the cache entry
+        return f'shelter_table-{hash_array(shelter_nodes)[:16]}'
+
+    def _save_shelter_table(self):
+        if self.cache is None:
+            return
+        table_dir = self._shelter_table_dir(self.shelter_table["shelter_nodes"])
+        for name, values in self.shelter_table.items():
+            self.cache.save_array(os.path.join(table_dir, f'{name}.npy'), values)
+
+    def _load_shelter_table(self, shelter_nodes):
+        if self.cache is None:
+            return None
+        table_dir = self._shelter_table_dir(shelter_nodes)
+        names = ("shelter_nodes", "shelter_index", "distance", "next_hop")
+        if not all(os.path.exists(self.cache.path(os.path.join(table_dir, f'{name}.npy'))) for name in names):
+            return None
+        table = {name: self.cache.load_array(os.path.join(table_dir, f'{name}.npy'), mmap_mode='r') for name in names}
+        if not np.array_equal(table["shelter_nodes"], shelter_nodes) or len(table["shelter_index"]) != self._num_nodes():
+            return None
+        return table
+
+    def get_nearest_shelter_path(self, start_point, end_points):
+        """
+        Get the end point with the shortest network distance from a start point, and the path to it,
+        by following the next hops of the shelter routing table.
+        :param start_point: The start location as an (x, y) tuple.
+        :type start_point: tuple
+        :param end_points: The shelter locations.
+        :type end_points: list of Point
+        :return: The index of the nearest end point (None if none is reachable), and the path.
+        :rtype: tuple
+        """
+
+        self.build_shelter_table(end_points)
+        start = self._node_index(self.snap_to_network(start_point))
+        shelter_index = int(self.shelter_table["shelter_index"][start])
+        if shelter_index < 0:
+            logger.warning(f"No shelter reachable from {start_point}")
+            return None, []
+        return shelter_index, self._node_coords(self._walk_next_hops(start))
+
+    def _walk_next_hops(self, start):
+        # The node ids from start to its nearest shelter, following the shelter table
+        next_hop = self.shelter_table["next_hop"]
+        path = [start]
+        while next_hop[path[-1]] >= 0:
+            path.append(int(next_hop[path[-1]]))
+        return path
+
+    def get_shelter_path_from(self, nodes):
+        """
+        Get the nearest shelter of a node and the path to it, avoiding the closed edges.
+        :param nodes: The node ids the path starts with, it goes on from the last one.
+        :type nodes: list of int
+        :return: The index of the nearest end point (None if none is reachable), and the path.
+        :rtype: tuple
+        """
+
+        shelter_index = int(self.shelter_table["shelter_index"][nodes[-1]])
+        if shelter_index < 0:
+            return None, []
+        return shelter_index, self._node_coords(nodes[:-1] + self._walk_next_hops(nodes[-1]))
+
+    def get_edge_nodes(self, edge):
+        # The start and end node ids of a directed edge id, see get_route_arrays
+        return divmod(int(edge), self._num_nodes())
+
+    def compute_edge_burn_times(self, arrival_seconds, transform):
+        """
+        Compute the time each edge burns, the earliest fire arrival time of the raster cells
+        it crosses, sampled every half cell along the edge. The edges are then closed in
+        that order by close_edges.
+        :param arrival_seconds: The fire arrival time of each raster cell in seconds, inf where the fire never arrives.
+        :type arrival_seconds: np.ndarray
+        :param transform: The affine transform of the raster.
+        :type transform: Affine
+        """
+
+        nodes = self._node_array()
+        adjacency = self._get_adjacency()
+        rows = np.repeat(np.arange(adjacency.shape[0]), np.diff(adjacency.indptr))
+        cols = np.asarray(adjacency.indices, dtype=np.int64)
+
+        # Sample both directions of an edge from the same end, so they burn at the same time
+        start = nodes[np.minimum(rows, cols)]
+        end = nodes[np.maximum(rows, cols)]
+        cell_size = min(abs(transform.a), abs(transform.e))
+        samples = np.ceil(np.asarray(adjacency.data) / (cell_size / 2)).astype(np.int64) + 1
+        entry = np.repeat(np.arange(len(rows)), samples)
+        first = np.cumsum(samples) - samples
+        t = (np.arange(len(entry)) - first[entry]) / (samples[entry] - 1)
+        xy = start[entry] + t[:, None] * (end - start)[entry]
+
+        col, row = ~transform @ (xy[:, 0], xy[:, 1])
+        row = np.floor(row).astype(np.int64)
+        col = np.floor(col).astype(np.int64)
+        height, width = arrival_seconds.shape
+        inside = (row >= 0) & (row < height) & (col >= 0) & (col < width)
+        arrival = np.full(len(entry), np.inf)
+        arrival[inside] = arrival_seconds[row[inside], col[inside]]
+        self.edge_burn_times = np.minimum.reduceat(arrival, first) if len(rows) else np.empty(0)
+
+        self.edge_closed = np.zeros(len(rows), dtype=bool)
+        self._closure_order = np.argsort(self.edge_burn_times, kind="stable")
+        self._closure_times = self.edge_burn_times[self._closure_order]
+        self._closure_pointer = 0
+
+    def next_closure_time(self):
+        # The burn time of the next edge to close, inf if there is none
+        if self._closure_order is None or self._closure_pointer == len(self._closure_order):
+            return np.inf
+        return float(self._closure_times[self._closure_pointer])
+
+    def close_edges(self, time):
+        """
+        Close the edges burnt by the given time, and repair the shelter table around them.
+        Requires compute_edge_burn_times.
+        :param time: The time in seconds.
+        :type time: float
+        :return: The directed edge ids of the newly closed edges, both directions of each edge.
+        :rtype: np.ndarray
+        """
+
+        end = max(int(np.searchsorted(self._closure_times, time, side="right")), self._closure_pointer)
+        closed = self._closure_order[self._closure_pointer:end]
+        self._closure_pointer = end
+        if closed.size == 0:
+            return np.empty(0, dtype=np.int64)
+
+        adjacency = self._get_adjacency()
+        self.edge_closed[closed] = True
+        rows = np.searchsorted(adjacency.indptr, closed, side="right") - 1
+        cols = np.asarray(adjacency.indices[closed], dtype=np.int64)
+        if self.shelter_table is not None:
+            self._repair_shelter_table(rows.tolist(), cols.tolist())
+        return rows * adjacency.shape[0] + cols
+
+    def is_edge_closed(self, u, v):
+        # Whether the edge between the node ids u and v is closed
+        if self.edge_closed is None:
+            return False
+        adjacency = self._get_adjacency()
+        for k in range(adjacency.indptr[u], adjacency.indptr[u + 1]):
+            if adjacency.indices[k] == v:
+                return bool(self.edge_closed[k])
+        return False
+
+    def _repair_shelter_table(self, rows, cols):
+        # Only the nodes whose path to their shelter used a closed edge, the subtrees below the
+        # closed next hops, can get farther from a shelter, the rest of the table still holds.
+        # Their distances are recomputed by a Dijkstra search over the subtrees, seeded from
+        # their neighbors outside of them
+        if self._tree_children is None:
+            # Writable copies of the (memory mapped) table, and the next hop tree
+            self.shelter_table = {name: np.array(values) for name, values in self.shelter_table.items()}
+            self._tree_children = [set() for _ in range(self._num_nodes())]
+            for node, hop in enumerate(self.shelter_table["next_hop"].tolist()):
+                if hop >= 0:
+                    self._tree_children[hop].add(node)
+        distance = self.shelter_table["distance"]
+        next_hop = self.shelter_table["next_hop"]
+        shelter_index = self.shelter_table["shelter_index"]
+        children = self._tree_children
+
+        roots = [u for u, v in zip(rows, cols) if next_hop[u] == v]
+        affected = set()
+        while roots:
+            node = roots.pop()
+            if node not in affected:
+                affected.add(node)
+                roots.extend(children[node])
+        if not affected:
+            return
+
+        adjacency = self._get_adjacency()
+        indptr, indices, weights, closed = adjacency.indptr, adjacency.indices, adjacency.data, self.edge_closed
+        previous_hop = {node: int(next_hop[node]) for node in affected}
+        distance[list(affected)] = np.inf
+
+        # Seed each affected node with its best open edge out of the subtrees
+        heap = []
+        for node in sorted(affected):
+            best, hop = np.inf, -1
+            for k in range(indptr[node], indptr[node + 1]):
+                other = int(indices[k])
+                if not closed[k] and other not in affected and distance[other] + weights[k] < best:
+                    best, hop = distance[other] + weights[k], other
+            distance[node] = best
+            next_hop[node] = hop
+            if hop >= 0:
+                heapq.heappush(heap, (best, node))
+
+        while heap:
+            node_distance, node = heapq.heappop(heap)
+            if node_distance > distance[node]:
+                continue
+            for k in range(indptr[node], indptr[node + 1]):
+                other = int(indices[k])
+                if not closed[k] and other in affected and node_distance + weights[k] < distance[other]:
+                    distance[other] = node_distance + weights[k]
+                    next_hop[other] = node
+                    heapq.heappush(heap, (distance[other], other))
+
+        # Update the tree, nearer nodes first so their next hops already know their shelter
+        for node, hop in previous_hop.items():
+            if hop >= 0:
+                children[hop].discard(node)
+        for node in sorted(affected, key=lambda node: distance[node]):
+            hop = int(next_hop[node])
+            if hop >= 0:
+                children[hop].add(node)
+                shelter_index[node] = shelter_index[hop]
+            else:
+                shelter_index[node] = -1
+
+    def _node_array(self):
+        # The (n, 2) node coordinates, in node id order
+        return np.array(self.node_list, dtype=np.float64).reshape(-1, 2)
+
+    def _get_adjacency(self):
+        # The adjacency matrix, without building the graph when it comes from the cache
+        if self._adjacency is None:
+            self._adjacency = self._graph_adjacency if self._graph_adjacency is not None else self._graph_arrays()[1]
+        return self._adjacency
+
+    def _graph_arrays(self):
+        # The node coordinates, in node id order, and the adjacency matrix of the graph
+        nodes = self._node_array()
+        edges = np.array([(self.node_ids[u], self.node_ids[v], w) for u, v, w in self.graph.edges(data='weight')]).reshape(-1, 3)
+        adjacency = self._build_adjacency(len(nodes), edges[:, 0].astype(np.int64), edges[:, 1].astype(np.int64), edges[:, 2])
+        return nodes, adjacency
+
+    def _load_graph_arrays(self, nodes, adjacency):
+        # The graph is only rebuilt from the cached arrays when it is first used,
+        # routing through the shelter table does not need it
+        self.node_list = [tuple(xy) for xy in nodes.tolist()]
+        self.node_ids = {node: i for i, node in enumerate(self.node_list)}
+        self.nodes = self.node_list
+        self._graph = nx.Graph()
+        self._graph_adjacency = adjacency
+        self.kdtree = KDTree(nodes)
+
+    @staticmethod
+    def _build_adjacency(n, start, end, weight):
+        # Store each undirected edge in both directions, once, dropping self loops
+        keep = start != end
+        rows = np.concatenate([start[keep], end[keep]])
+        cols = np.concatenate([end[keep], start[keep]])
+        data = np.concatenate([weight[keep], weight[keep]])
+        order = np.lexsort((data, cols, rows))
+        rows, cols, data = rows[order], cols[order], data[order]
+        first = np.ones(len(rows), dtype=bool)
+        first[1:] = (rows[1:] != rows[:-1]) | (cols[1:] != cols[:-1])
+        return sparse.csr_matrix((data[first], (rows[first], cols[first])), shape=(n, n))
 
     def save_to_cache(self):
-        os.makedirs(self.cache_dir, exist_ok=True)
-        with open(os.path.join(self.cache_dir, 'nodes.pkl'), 'wb') as f:
-            pickle.dump(self.nodes, f)
-        with open(os.path.join(self.cache_dir, 'edges.pkl'), 'wb') as f:
-            pickle.dump(self.graph.edges(data=True), f)
-        with open(os.path.join(self.cache_dir, 'kdtree.pkl'), 'wb') as f:
-            pickle.dump(self.kdtree, f)
+        if self.cache is None:
+            return
+        nodes, adjacency = self._graph_arrays()
+        self.cache.save_array('nodes.npy', np.ascontiguousarray(nodes, dtype=np.float64))
+        self.cache.save_array('indptr.npy', adjacency.indptr.astype(np.int32))
+        self.cache.save_array('indices.npy', adjacency.indices.astype(np.int32))
+        self.cache.save_array('weights.npy', adjacency.data.astype(np.float64))
+        self.cache.write_manifest(self.cache_files)
 
     def save_shortest_paths_cache(self):
-        os.makedirs(self.cache_dir, exist_ok=True)
-        with open(os.path.join(self.cache_dir, 'shortest_paths.pkl'), 'wb') as f:
-            pickle.dump(self.shortest_paths, f)
+        if self.cache is None:
+            return
+        self.cache.save_paths(self.shortest_paths)
 
     def load_from_cache(self):
-        with open(os.path.join(self.cache_dir, 'nodes.pkl'), 'rb') as f:
-            self.nodes = pickle.load(f)
-        with open(os.path.join(self.cache_dir, 'edges.pkl'), 'rb') as f:
-            edges = pickle.load(f)
-            self.graph.add_edges_from(edges)
-        with open(os.path.join(self.cache_dir, 'kdtree.pkl'), 'rb') as f:
-            self.kdtree = pickle.load(f)
-        with open(os.path.join(self.cache_dir, 'shortest_paths.pkl'), 'rb') as f:
-            self.shortest_paths = pickle.load(f)
+        # The arrays are memory mapped, the adjacency matrix is built on them without copying
+        nodes = self.cache.load_array('nodes.npy', mmap_mode='r')
+        indptr = self.cache.load_array('indptr.npy', mmap_mode='r')
+        indices = self.cache.load_array('indices.npy', mmap_mode='r')
+        weights = self.cache.load_array('weights.npy', mmap_mode='r')
+        adjacency = sparse.csr_matrix((weights, indices, indptr), shape=(len(nodes), len(nodes)), copy=False)
+        self._load_graph_arrays(nodes, adjacency)
+        self.shortest_paths = self.cache.load_paths()
 
     def clear_cache(self):
-        if os.path.exists(os.path.join(self.cache_dir, 'nodes.pkl')):
-            os.remove(os.path.join(self.cache_dir, 'nodes.pkl'))
-        if os.path.exists(os.path.join(self.cache_dir, 'edges.pkl')):
-            os.remove(os.path.join(self.cache_dir, 'edges.pkl'))
-        if os.path.exists(os.path.join(self.cache_dir, 'kdtree.pkl')):
-            os.remove(os.path.join(self.cache_dir, 'kdtree.pkl'))
-        if os.path.exists(os.path.join(self.cache_dir, 'shortest_paths.pkl')):
-            os.remove(os.path.join(self.cache_dir, 'shortest_paths.pkl'))
+        # Remove the entry of this network, or every entry if the network has no inputs to address it
+        if self.cache is not None:
+            self.cache.clear()
+        else:
+            NetworkCache.clear_all(self.cache_dir)
 
     def batch_calculate_shortest_paths(self, start_points, end_points):
-        for start_point in start_points:
-            for end_point in end_points:
-                self.get_shortest_path((start_point.x, start_point.y), (end_point.x, end_point.y))
-        self.save_shortest_paths_cache()
+        """
+        Prepare the shortest paths from any start point to the end points. One shortest path
+        tree is built per end point, so the cost does not depend on the number of start points,
+        and the shelter routing table is built (or loaded) from them.
+        """
+
+        self.build_shelter_table(end_points)
+        if self.shortest_paths:
+            self.save_shortest_paths_cache()
+
+class SparseRoadNetwork(RoadNetwork):
+    """
+    A RoadNetwork backed by integer node ids, an (n, 2) node coordinate array and a
+    symmetric CSR adjacency matrix of edge lengths. Routing goes through
+    scipy.sparse.csgraph. Nodes are still exchanged as (x, y) tuples, so it can
+    be used in place of the networkx backend.
+    """
+
+    def __init__(self, geo_series: gpd.GeoSeries = None, cache_dir="cache", use_cache=True, max_cached_paths=100000):
+        self.adjacency = None
+        super().__init__(geo_series, cache_dir=cache_dir, use_cache=use_cache, max_cached_paths=max_cached_paths)
+        self.graph = None
+
+    def _build_graph(self, geo_series: gpd.GeoSeries):
+        geoms = np.asarray(geo_series, dtype=object)
+        geoms = geoms[shapely.get_type_id(geoms) == shapely.GeometryType.LINESTRING]
+        coords, line = shapely.get_coordinates(geoms, return_index=True)
+
+        # Unique nodes, and the segments between consecutive vertices of each line
+        self.nodes, node = np.unique(coords, axis=0, return_inverse=True)
+        node = node.reshape(-1)
+        same_line = line[:-1] == line[1:]
+        start, end = node[:-1][same_line], node[1:][same_line]
+        delta = coords[1:][same_line] - coords[:-1][same_line]
+        weight = np.sqrt(delta[:, 0] * delta[:, 0] + delta[:, 1] * delta[:, 1])
+        self.adjacency = self._build_adjacency(len(self.nodes), start, end, weight)
+
+    def _index_nodes(self):
+        # Node ids are the rows of self.nodes
+        pass
+
+    def _num_nodes(self):
+        return len(self.nodes)
+
+    def _node_coords(self, ids):
+        return [tuple(xy) for xy in self.nodes[ids].tolist()]
+
+    def _node_index(self, node):
+        return int(self.kdtree.query(node)[1])
+
+    def snap_to_network(self, point):
+        distance, idx = self.kdtree.query(point)
+        return tuple(self.nodes[idx].tolist())
+
+    def _path_from_predecessors(self, predecessors, start, end):
+        # Follow the predecessors from start up to the root end, as (x, y) tuples
+        path = [start]
+        while path[-1] != end:
+            if path[-1] < 0:
+                return []
+            path.append(predecessors[path[-1]])
+        return self._node_coords(path)
+
+    def get_shortest_path(self, start_point, end_point):
+        logger.debug(f"Calculating shortest path from {start_point} to {end_point}")
+        start_point = self.snap_to_network(start_point)
+        end_point = self.snap_to_network(end_point)
+        path_key = (start_point, end_point)
+
+        if end_point in self.shelter_trees:
+            return self._walk_shelter_tree(start_point, end_point)
+        if path_key in self.shortest_paths:
+            self.shortest_paths.move_to_end(path_key)
+            return self.shortest_paths[path_key]
+
+        # Search from the end point, the predecessors then lead to it from the start point
+        start, end = self._node_index(start_point), self._node_index(end_point)
+        _, predecessors = csgraph.dijkstra(self.adjacency, directed=False, indices=end, return_predecessors=True)
+        path = self._path_from_predecessors(predecessors, start, end)
+        if not path:
+            logger.warning(f"No path found from {start_point} to {end_point}")
+            return []
+        self._cache_path(path_key, path)
+        return path
+
+    def build_shelter_trees(self, end_points):
+        """
+        Build the shortest path trees of all new end points with a single csgraph.dijkstra call.
+        :param end_points: The shelter locations.
+        :type end_points: list of Point
+        """
+
+        end_nodes = []
+        for end_point in end_points:
+            end_node = self.snap_to_network((end_point.x, end_point.y))
+            if end_node not in self.shelter_trees and end_node not in end_nodes:
+                end_nodes.append(end_node)
+        if not end_nodes:
+            return
+        indices = [self._node_index(end_node) for end_node in end_nodes]
+        distances, predecessors = csgraph.dijkstra(
+            self.adjacency, directed=False, indices=indices, return_predecessors=True
+        )
+        for end_node, end, predecessor_row, distance_row in zip(end_nodes, indices, predecessors, distances):
+            self.shelter_trees[end_node] = (end, predecessor_row, distance_row)
+
+    def _tree_arrays(self, end_node):
+        _, predecessors, distances = self.shelter_trees[end_node]
+        return distances, np.where(predecessors < 0, -1, predecessors).astype(np.int32)
+
+    def _walk_shelter_tree(self, start_node, end_node):
+        end, predecessors, _ = self.shelter_trees[end_node]
+        return self._path_from_predecessors(predecessors, self._node_index(start_node), end)
+
+    def get_route_arrays(self, path):
+        coords = np.asarray(path, dtype=float).reshape(-1, 2)
+        delta = np.diff(coords, axis=0)
+        cum = np.concatenate([[0.0], np.cumsum(np.sqrt(delta[:, 0] * delta[:, 0] + delta[:, 1] * delta[:, 1]))])
+        ids = self.kdtree.query(coords)[1].astype(np.int64) if len(coords) else np.empty(0, dtype=np.int64)
+        edges = ids[:-1] * len(self.nodes) + ids[1:]
+        return edges, cum
+
+    def _node_array(self):
+        return self.nodes
+
+    def _get_adjacency(self):
+        return self.adjacency
+
+    def _graph_arrays(self):
+        return self.nodes, self.adjacency
+
+    def _load_graph_arrays(self, nodes, adjacency):
+        # The cached arrays are used as they are, only the KD-tree is rebuilt
+        self.nodes = nodes
+        self.adjacency = adjacency
+        self.kdtree = KDTree(nodes)
 
 def example():
     # Example usage:
     geo_series = gpd.GeoSeries([LineString([(0, 0), (1, 1), (2, 2)]), LineString([(2, 2), (3, 3)])])
     road_network = RoadNetwork(geo_series)
     shortest_path = road_network.get_shortest_path((0.5, 0.5), (3, 3))
+    road_network.save_shortest_paths_cache()
     print(shortest_path)
 
-    # Loading from cache
-    road_network_cached = RoadNetwork(use_cache=True)
-    road_network_cached.load_from_cache()
+    # Loading from cache, the entry is found from the hash of the geometries
+    road_network_cached = RoadNetwork(geo_series, use_cache=True)
     shortest_path_cached = road_network_cached.get_shortest_path((0.5, 0.5), (3, 3))
     print(shortest_path_cached)
 
 def demo():
+    import matplotlib.pyplot as plt
+
     # Demo usage using shapefile
     geo_series = gpd.read_file('data/gcs/road_network.shp')['geometry']
     road_network = RoadNetwork(geo_series, use_cache=True)
@@ -196,6 +818,7 @@ def demo_clear_cache():
     road_network.clear_cache()
 
 if __name__ == "__main__":
+    setup_logging()
     start_time = time.time()
     
     # example()
@@ -0,0 +1,118 @@
+import heapq
+import numpy as np
+from profiler import phase
+
+class ResidentScheduler:
+    """
+    Event driven activation of the `Resident` agents, with the same results as stepping
+    and advancing every resident every step:
+
+    - waiting residents sleep in a heap until their decision time,
+    - evacuating residents are stepped and advanced every step,
+    - waiting, evacuated and stranded residents do not move, so they are only checked for fire
+      when their raster cell burns, or once after they stop in a cell that already burnt,
+    - dead residents are dropped.
+
+    The cost of a step is proportional to the number of moving residents, plus the
+    residents woken up and the raster cells ignited in the step.
+
+    With `sequential` updates, each moving resident is stepped and advanced before the
+    next one, in the order of `residents`. Otherwise every moving resident is stepped,
+    choosing its speed from the state at the start of the step, and then advanced.
+    """
+
+    def __init__(self, model, residents, sequential=True):
+        self.model = model
+        self.sequential = sequential
+        self.order = {agent: i for i, agent in enumerate(residents)}
+        self.waiting = [(agent.decision_time, i, agent) for i, agent in enumerate(residents)]  # heap
+        heapq.heapify(self.waiting)
+        self.moving = []  # evacuating residents
+        self.stationary = {}  # raster cell index -> waiting or evacuated residents in the cell
+        self.stopped = []  # residents evacuated in the last step, checked for fire once
+        for agent in residents:
+            self.add_stationary(agent)
+
+    def get_cell(self, agent):
+        return int(self.model.get_cell_index(agent.geometry.x, agent.geometry.y))
+
+    def add_stationary(self, agent):
+        cell = self.get_cell(agent)
+        if cell >= 0:
+            self.stationary.setdefault(cell, {})[agent] = None
+
+    def remove_stationary(self, agent):
+        self.stationary.get(self.get_cell(agent), {}).pop(agent, None)
+
+    def step(self):
+        model = self.model
+        layer = model.fire_hazard_layer
+        profiler = model.profiler
+
+        # Residents standing in the cells ignited in this step, or stopped in a burnt cell
+        with phase(profiler, "fire_check"):
+            for cell in np.ravel_multi_index(layer.newly_burnt, layer.is_burnt.shape).tolist():
+                for agent in self.stationary.pop(cell, {}):
+                    agent.status = "dead"
+            for agent in self.stopped:
+                if agent.status != "dead" and model.fire_reached(agent.geometry.x, agent.geometry.y):
+                    agent.status = "dead"
+                    self.remove_stationary(agent)
+            self.stopped = []
+
+        # Wake the residents whose decision time has passed
+        with phase(profiler, "wake"):
+            woken = False
+            while self.waiting and self.waiting[0][0] <= model.time_elapsed:
+                agent = heapq.heappop(self.waiting)[2]
+                if agent.status != "dead":
+                    self.remove_stationary(agent)
+                    self.moving.append(agent)
+                    woken = True
+            if woken and self.sequential:
+                self.moving.sort(key=self.order.__getitem__)
+
+        if self.sequential:
+            # Each resident moves as soon as it has chosen its speed, the next ones see it moved
+            with phase(profiler, "step"):
+                for agent in self.moving:
+                    agent.step()
+                    agent.advance()
+        else:
+            # Residents choose their speeds from the state at the start of the step, then all of them move
+            with phase(profiler, "step"):
+                for agent in self.moving:
+                    agent.step()
+            with phase(profiler, "advance"):
+                for agent in self.moving:
+                    agent.advance()
+
+        # Drop the residents that stopped moving
+        moving = []
+        for agent in self.moving:
+            if agent.status == "evacuating":
+                moving.append(agent)
+            elif agent.status in ("evacuated", "stranded"):
+                self.add_stationary(agent)
+                self.stopped.append(agent)
+        self.moving = moving
+
+    def next_event_time(self):
+        """
+        The time of the next event that can change a resident, when no resident is moving.
+        :return: The time in seconds of the next decision time or fire arrival in a cell
+            with a waiting or evacuated resident (inf if there is none), None while some
+            residents are moving or still have to be checked for fire.
+        :rtype: float
+        """
+
+        if self.moving or self.stopped:
+            return None
+        while self.waiting and self.waiting[0][2].status == "dead":
+            heapq.heappop(self.waiting)
+        next_time = self.waiting[0][0] if self.waiting else np.inf
+        cells = [cell for cell, agents in self.stationary.items() if agents]
+        if cells:
+            arrival = self.model.fire_hazard_layer.fire_arrival_seconds.reshape(-1)[cells]
+            next_time = min(next_time, arrival.min())
+        return float(next_time)
@@ -0,0 +1,162 @@
+import argparse
+import json
+import os
+import time
+from batch import DATA_PARAMS, get_fieldnames, get_results_row, get_results_writer, get_run_id, load_finished, run_batch, scenario_grid
+from model import EvacuationModel
+from road_network import setup_logging
+
+# Parameters of the headless runs, unless the scenario config sets them
+DEFAULT_PARAMETERS = {"engine": "vectorized", "sync_agents": False}
+
+def load_config(path):
+    """
+    Read a scenario config, a JSON file such as:
+
+        {
+            "data": {"road_network_shp": "data/pcs/road_network.shp", "hazard_raster": "data/pcs/fire_arrival_time.asc"},
+            "parameters": {"num_residents": [500, 1000], "Rtau": 45, "fast_forward": true},
+            "seeds": [1, 2, 3],
+            "max_steps": 10800,
+            "output": "results",
+            "record": {"sample_interval": 10, "file_format": "parquet"},
+            "progress_interval": 600,
+            "workers": 1
+        }
+
+    `data` takes the data arguments of EvacuationModel (the bundled dataset by default),
+    and `parameters` its other arguments, a list of values runs one scenario per value
+    (every combination for several lists). Every scenario runs once per seed, once with
+    a seed drawn from the operating system without `seeds`. `record` is optional and
+    writes the outputs of each run with a Recorder.
+    :param path: The path of the config file.
+    :type path: str
+    :return: The config, with the defaults filled in.
+    :rtype: dict
+    """
+
+    with open(path) as f:
+        config = json.load(f)
+    unknown = set(config) - {"data", "parameters", "seeds", "max_steps", "output", "record", "progress_interval", "workers"}
+    if unknown:
+        raise ValueError(f"Unknown config keys: {', '.join(sorted(unknown))}")
+    unknown = set(config.get("data", {})) - set(DATA_PARAMS)
+    if unknown:
+        raise ValueError(f"Unknown data keys: {', '.join(sorted(unknown))}, expected some of {', '.join(DATA_PARAMS)}")
+    config.setdefault("data", {})
+    config.setdefault("parameters", {})
+    config.setdefault("seeds", [None])
+    config.setdefault("max_steps", None)
+    config.setdefault("output", "results")
+    config.setdefault("record", None)
+    config.setdefault("progress_interval", 600)
+    config.setdefault("workers", 1)
+    return config
+
+def get_runs(config):
+    # The EvacuationModel parameters of every run of the config
+    parameters = {**DEFAULT_PARAMETERS, **config["data"], **config["parameters"]}
+    grid = {name: value if isinstance(value, list) else [value] for name, value in parameters.items()}
+    return scenario_grid({**grid, "rng": config["seeds"]})
+
+def run(params, max_steps=None, progress_interval=600, recorder=None, name="run"):
+    """
+    Run one scenario until every resident is evacuated or dead, or for max_steps,
+    printing its progress every progress_interval steps.
+    :param params: The EvacuationModel parameters.
+    :type params: dict
+    :param max_steps: The maximum number of steps, unbounded if None.
+    :type max_steps: int
+    :param progress_interval: The number of steps between progress reports, none if None.
+    :type progress_interval: int
+    :param recorder: A Recorder of the outputs of the run, optional.
+    :type recorder: Recorder
+    :param name: The name of the run in the progress reports.
+    :type name: str
+    :return: The results row of the run, see batch.get_results_row.
+    :rtype: dict
+    """
+
+    start = time.perf_counter()
+    model = EvacuationModel(**params, recorder=recorder)
+    model.max_steps = max_steps
+    print(f"{name}: {model.num_residents} residents, initialized in {time.perf_counter() - start:.1f} s", flush=True)
+
+    next_report = progress_interval
+    while model.running and (max_steps is None or model.steps < max_steps):
+        model.step()
+        if progress_interval and model.steps >= next_report:
+            elapsed = time.perf_counter() - start
+            print(
+                f"{name}: step {model.steps} ({model.time_elapsed / 60:.0f} min), {model.n_evacuated} evacuated, "
+                f"{model.n_dead} dead, {elapsed:.1f} s", flush=True
+            )
+            next_report = (model.steps // progress_interval + 1) * progress_interval
+    return get_results_row(params, model, time.perf_counter() - start)
+
+def run_config(config):
+    """
+    Run every scenario of a config, see load_config. One row per run is appended to
+    `<output>/results.csv` as it finishes, and the runs already in it are skipped, so
+    an interrupted job resumes where it stopped. With more than one worker the runs
+    are spread over a process pool with batch.run_batch, and only their completion is
+    reported.
+    :param config: The config.
+    :type config: dict
+    :return: The number of runs done.
+    :rtype: int
+    """
+
+    output = config["output"]
+    os.makedirs(output, exist_ok=True)
+    results_file = os.path.join(output, "results.csv")
+    runs = get_runs(config)
+    with open(os.path.join(output, "config.json"), "w") as f:
+        json.dump(config, f, indent=2)
+
+    if config["workers"] != 1:
+        if config["record"] is not None:
+            raise ValueError("Recording the runs requires a single worker")
+        return run_batch(runs, results_file=results_file, max_workers=config["workers"], max_steps=config["max_steps"])
+
+    # The columns are fixed from the whole grid before any run, runs may set different parameters
+    fieldnames = get_fieldnames(runs)
+    with open(results_file, "a", newline="") as f:
+        get_results_writer(f, results_file, fieldnames)
+    finished = load_finished(results_file)
+    pending = [(i, params) for i, params in enumerate(runs) if get_run_id(params) not in finished]
+    print(f"{len(runs) - len(pending)} runs already done, {len(pending)} to run", flush=True)
+    for i, params in pending:
+        name = f"run_{i:04d}"
+        if config["record"] is not None:
+            from recorder import Recorder
+
+            with Recorder(os.path.join(output, name), **config["record"]) as recorder:
+                row = run(params, config["max_steps"], config["progress_interval"], recorder, name)
+        else:
+            row = run(params, config["max_steps"], config["progress_interval"], name=name)
+        print(f"{name}: done in {row['steps']} steps, {row['n_evacuated']} evacuated, {row['n_dead']} dead, "
+              f"{row['runtime']} s", flush=True)
+        append_results_row(results_file, row, fieldnames)
+    return len(pending)
+
+def append_results_row(results_file, row, fieldnames):
+    # Append a row, under the header of the file, see batch.get_results_writer
+    with open(results_file, "a", newline="") as f:
+        get_results_writer(f, results_file, fieldnames).writerow(row)
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Run evacuation scenarios without the visualization.")
+    parser.add_argument("config", help="the JSON scenario config")
+    parser.add_argument("--output", help="the output directory, overrides the config")
+    parser.add_argument("--max-steps", type=int, help="the step budget of each run, overrides the config")
+    parser.add_argument("--progress-interval", type=int, help="the steps between progress reports, overrides the config")
+    parser.add_argument("--workers", type=int, help="the number of worker processes, overrides the config")
+    args = parser.parse_args()
+
+    config = load_config(args.config)
+    for key in ("output", "max_steps", "progress_interval", "workers"):
+        if getattr(args, key) is not None:
+            config[key] = getattr(args, key)
+    setup_logging()
+    run_config(config)
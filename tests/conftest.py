@@ -0,0 +1,15 @@
+import pytest
+from benchmark import make_grid_dataset
+
+@pytest.fixture(scope="session")
+def grid_dataset(tmp_path_factory):
+    # The data parameters of a small generated grid dataset, with its own network cache
+    directory = tmp_path_factory.mktemp("grid")
+    params = make_grid_dataset(str(directory / "data"), grid_size=8, n_population=400, spread_rate=8)
+    params["cache_dir"] = str(directory / "cache")
+    return params
+
+@pytest.fixture
+def grid_run(grid_dataset):
+    # A run on the grid dataset where the residents meet in traffic and a few of them burn
+    return {"num_residents": 300, "rng": 7, "Rtau": 20, **grid_dataset}
@@ -0,0 +1,58 @@
+import csv
+import logging
+from batch import get_run_id, load_finished, run_batch, scenario_grid
+
+def read_rows(results_file):
+    with open(results_file, newline="") as f:
+        return list(csv.DictReader(f))
+
+def test_resume_skips_finished_runs(grid_dataset, tmp_path):
+    results_file = str(tmp_path / "results.csv")
+    scenarios = scenario_grid({"num_residents": [20, 30]}, engine="vectorized", rng=1, **grid_dataset)
+
+    assert load_finished(results_file) == set()
+    assert run_batch(scenarios[:1], results_file=results_file, max_workers=2) == 1
+    assert load_finished(results_file) == {get_run_id(scenarios[0])}
+
+    # Only the run missing from the results file is done
+    assert run_batch(scenarios, results_file=results_file, max_workers=2) == 1
+    rows = read_rows(results_file)
+    assert sorted(row["num_residents"] for row in rows) == ["20", "30"]
+    assert load_finished(results_file) == {get_run_id(params) for params in scenarios}
+    assert run_batch(scenarios, results_file=results_file, max_workers=2) == 0
+
+def test_load_finished_skips_truncated_rows(grid_dataset, tmp_path):
+    results_file = str(tmp_path / "results.csv")
+    scenarios = scenario_grid({"num_residents": [20]}, engine="vectorized", rng=1, **grid_dataset)
+    run_batch(scenarios, results_file=results_file, max_workers=1)
+
+    # A row cut short by an interrupted batch does not count as finished
+    with open(results_file) as f:
+        text = f.read()
+    with open(results_file, "w") as f:
+        f.write(text.rstrip("\n").rsplit(",", 2)[0])
+    assert load_finished(results_file) == set()
+
+def test_moved_cache_keeps_finished_runs(grid_dataset, tmp_path):
+    results_file = str(tmp_path / "results.csv")
+    scenarios = scenario_grid({"num_residents": [20]}, engine="vectorized", rng=1, **grid_dataset)
+    run_batch(scenarios, results_file=results_file, max_workers=1)
+
+    moved = [dict(params, cache_dir=str(tmp_path / "moved")) for params in scenarios]
+    assert get_run_id(moved[0]) == get_run_id(scenarios[0])
+    assert run_batch(moved, results_file=results_file, max_workers=1) == 0
+
+def test_failed_runs_are_logged_and_left_out(grid_dataset, tmp_path, caplog):
+    results_file = str(tmp_path / "results.csv")
+    scenarios = scenario_grid({"engine": ["vectorized", "bogus"]}, num_residents=20, rng=1, **grid_dataset)
+
+    with caplog.at_level(logging.ERROR, logger="batch"):
+        assert run_batch(scenarios, results_file=results_file, max_workers=2) == 1
+    failed = [record for record in caplog.records if record.name == "batch"]
+    assert len(failed) == 1
+    assert get_run_id(scenarios[1]) in failed[0].getMessage()
+    assert "Unknown engine: bogus" in failed[0].exc_text
+
+    # The failed run is not in the results file, so it runs again on resume
+    assert [row["engine"] for row in read_rows(results_file)] == ["vectorized"]
+    assert load_finished(results_file) == {get_run_id(scenarios[0])}
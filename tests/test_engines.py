@@ -0,0 +1,38 @@
+import numpy as np
+import pytest
+from model import EvacuationModel
+
+def run(max_steps=20000, **params):
+    model = EvacuationModel(**params)
+    while model.running and model.steps < max_steps:
+        model.step()
+    return model
+
+def test_vectorized_engine_matches_simultaneous_agents(grid_run):
+    agents = run(engine="agents", update="simultaneous", **grid_run)
+    vectorized = run(engine="vectorized", **grid_run)
+
+    assert not agents.running and not vectorized.running
+    assert agents.steps == vectorized.steps
+    assert agents.status_counts == vectorized.status_counts
+    assert agents.n_dead > 0 and agents.n_evacuated > 0
+    assert sorted(agents.evacuation_time_list) == sorted(vectorized.evacuation_time_list)
+    np.testing.assert_array_equal(agents.get_status_codes(), vectorized.get_status_codes())
+
+def test_sequential_updates_differ_from_simultaneous(grid_run):
+    # The residents meet in traffic, so the update order shows in the results
+    sequential = run(engine="agents", **grid_run)
+    simultaneous = run(engine="agents", update="simultaneous", **grid_run)
+    assert sequential.update == "sequential"
+    assert sequential.steps != simultaneous.steps
+
+def test_vectorized_engine_rejects_sequential_updates(grid_dataset):
+    with pytest.raises(ValueError):
+        EvacuationModel(num_residents=10, engine="vectorized", update="sequential", **grid_dataset)
+
+def test_sequential_default_baseline(grid_run):
+    # The baseline of the agents engine with its default sequential updates
+    model = run(**grid_run)
+    assert model.steps == 1912
+    assert model.status_counts == {"waiting": 0, "evacuating": 0, "evacuated": 288, "dead": 12, "stranded": 0}
+    assert np.mean(model.evacuation_time_list) == pytest.approx(24.7052, abs=1e-4)
@@ -0,0 +1,26 @@
+import numpy as np
+import pytest
+from model import EvacuationModel
+
+@pytest.mark.parametrize("engine", ["agents", "vectorized"])
+def test_fast_forward_matches_stepping(grid_run, engine):
+    models, calls = [], []
+    for fast_forward in (False, True):
+        model = EvacuationModel(engine=engine, update="simultaneous", fast_forward=fast_forward, **grid_run)
+        n_calls = 0
+        while model.running:
+            model.step()
+            n_calls += 1
+        models.append(model)
+        calls.append(n_calls)
+    stepped, forwarded = models
+
+    # The fast forward skips the steps before the first departure at least
+    assert calls[0] == stepped.steps
+    assert calls[1] < forwarded.steps
+
+    assert forwarded.steps == stepped.steps
+    assert forwarded.time_elapsed == stepped.time_elapsed
+    assert forwarded.status_counts == stepped.status_counts
+    assert forwarded.evacuation_time_list == stepped.evacuation_time_list
+    np.testing.assert_array_equal(forwarded.get_status_codes(), stepped.get_status_codes())
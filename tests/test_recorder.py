@@ -0,0 +1,35 @@
+import numpy as np
+import pytest
+from model import EvacuationModel
+
+pq = pytest.importorskip("pyarrow.parquet")
+from recorder import Recorder
+
+def test_recorder_files(grid_run, tmp_path):
+    path = str(tmp_path / "run")
+    with Recorder(path, sample_interval=7, chunk_size=64) as recorder:
+        model = EvacuationModel(engine="vectorized", recorder=recorder, **grid_run)
+        while model.running:
+            model.step()
+
+    steps = pq.read_table(f"{path}_steps.parquet").to_pydict()
+    events = pq.read_table(f"{path}_events.parquet").to_pydict()
+    assert list(steps) == [
+        "step", "time_elapsed", "n_waiting", "n_evacuating", "n_evacuated", "n_dead", "n_stranded"
+    ]
+    assert list(events) == ["step", "time_elapsed", "resident_id", "event"]
+
+    # Every sample_interval steps, and the step the model stopped at once
+    assert model.steps % 7 != 0
+    assert steps["step"] == [*range(0, model.steps, 7), model.steps]
+    final = {name[2:]: values[-1] for name, values in steps.items() if name.startswith("n_")}
+    assert final == model.status_counts
+    totals = np.sum([steps[f"n_{name}"] for name in model.status_counts], axis=0)
+    assert (totals == model.num_residents).all()
+
+    # One event per resident out of the evacuation, with its evacuation time
+    assert len(set(events["resident_id"])) == len(events["resident_id"]) == model.num_residents
+    for status in ("evacuated", "dead", "stranded"):
+        assert events["event"].count(status) == model.status_counts[status]
+    evacuated = [time for time, event in zip(events["time_elapsed"], events["event"]) if event == "evacuated"]
+    np.testing.assert_allclose(np.sort(evacuated) / 60, np.sort(model.evacuation_time_list))
@@ -0,0 +1,72 @@
+import geopandas as gpd
+import numpy as np
+import pytest
+import rasterio
+from shapely.geometry import LineString
+from road_network import RoadNetwork, SparseRoadNetwork
+
+BACKENDS = {"networkx": RoadNetwork, "sparse": SparseRoadNetwork}
+
+def jittered_roads(road_network_shp, seed=0):
+    # The roads of the grid with their intersections moved a little, so the shortest
+    # paths have no ties and the routing table of a network is unique
+    rng = np.random.default_rng(seed)
+    moved = {}
+    roads = []
+    for line in gpd.read_file(road_network_shp).geometry:
+        coords = [moved.setdefault(xy, tuple(np.add(xy, rng.uniform(-10, 10, 2)))) for xy in line.coords]
+        roads.append(LineString(coords))
+    return gpd.GeoSeries(roads)
+
+def open_roads(network):
+    # The open edges of a network, each once
+    adjacency = network._get_adjacency()
+    rows = np.repeat(np.arange(adjacency.shape[0]), np.diff(adjacency.indptr))
+    nodes = network._node_array()
+    return gpd.GeoSeries([
+        LineString([nodes[u], nodes[v]])
+        for u, v, closed in zip(rows.tolist(), adjacency.indices.tolist(), network.edge_closed.tolist())
+        if u < v and not closed
+    ])
+
+@pytest.mark.parametrize("backend", BACKENDS)
+def test_repaired_table_matches_rebuilt_table(grid_dataset, tmp_path, backend):
+    network_class = BACKENDS[backend]
+    shelters = list(gpd.read_file(grid_dataset["shelters_shp"]).geometry)
+    network = network_class(jittered_roads(grid_dataset["road_network_shp"]), cache_dir=str(tmp_path / "cache"))
+    network.build_shelter_table(shelters)
+    initial_distance = np.array(network.shelter_table["distance"])
+    with rasterio.open(grid_dataset["hazard_raster"]) as src:
+        network.compute_edge_burn_times(src.read(1).astype(float) * 60, src.transform)
+
+    nodes = [tuple(xy) for xy in network._node_array().tolist()]
+    burn_times = np.unique(network.edge_burn_times)
+    n_repaired = 0
+    for time in np.quantile(burn_times, [0.2, 0.4, 0.6]):
+        closed = network.close_edges(time)
+        assert closed.size > 0
+        table = network.shelter_table
+
+        rebuilt = network_class(open_roads(network), use_cache=False)
+        rebuilt.build_shelter_table(shelters)
+        expected = rebuilt.shelter_table
+        rebuilt_nodes = [tuple(xy) for xy in rebuilt._node_array().tolist()]
+        assert [rebuilt_nodes[i] for i in expected["shelter_nodes"]] == [nodes[i] for i in table["shelter_nodes"]]
+
+        # Nodes cut off from every road are out of the rebuilt network, and out of reach
+        index = {node: i for i, node in enumerate(rebuilt_nodes)}
+        ids = np.array([index.get(node, -1) for node in nodes])
+        kept = ids >= 0
+        assert np.isinf(table["distance"][~kept]).all()
+        np.testing.assert_allclose(table["distance"][kept], expected["distance"][ids[kept]])
+        np.testing.assert_array_equal(table["shelter_index"][kept], expected["shelter_index"][ids[kept]])
+        hops = [nodes[hop] if hop >= 0 else None for hop in table["next_hop"][kept].tolist()]
+        expected_hops = [rebuilt_nodes[hop] if hop >= 0 else None for hop in expected["next_hop"][ids[kept]].tolist()]
+        assert hops == expected_hops
+        n_repaired += 1
+
+    # The fire makes some nodes farther from their shelters, and cuts some off
+    assert n_repaired == 3
+    distance = network.shelter_table["distance"]
+    assert (np.isfinite(distance) & (distance > initial_distance + 1)).any()
+    assert (network.shelter_table["shelter_index"] == -1).any()
@@ -0,0 +1,36 @@
+import geopandas as gpd
+import pytest
+from shapely.geometry import LineString, Point
+from benchmark import make_grid_dataset
+from agents import Resident
+from model import EvacuationModel
+
+@pytest.fixture
+def dataset(tmp_path):
+    # A small grid dataset, plus a road out of the reach of both the shelters and the fire
+    # with one resident on it
+    params = make_grid_dataset(str(tmp_path / "grid"), grid_size=5, n_population=20, spread_rate=5)
+    params["cache_dir"] = str(tmp_path / "cache")
+    roads = gpd.read_file(params["road_network_shp"])
+    isolated = LineString([(505000, 4005000), (505100, 4005000)])
+    gpd.GeoDataFrame(geometry=[*roads.geometry, isolated], crs=roads.crs).to_file(params["road_network_shp"])
+    population = gpd.read_file(params["population_distribution_shp"])
+    stranded = Point(505050, 4005010)
+    gpd.GeoDataFrame(geometry=[*population.geometry, stranded], crs=population.crs).to_file(
+        params["population_distribution_shp"]
+    )
+    return params, stranded
+
+@pytest.mark.parametrize("engine", ["agents", "vectorized"])
+def test_resident_without_shelter_is_stranded(dataset, engine):
+    params, stranded = dataset
+    model = EvacuationModel(num_residents=21, engine=engine, Rtau=1, rng=0, **params)
+    while model.running and model.steps < 20000:
+        model.step()
+
+    assert not model.running
+    assert model.n_stranded == 1
+    assert model.n_evacuated + model.n_dead == 20
+    assert len(model.evacuation_time_list) == model.n_evacuated
+    statuses = {(agent.geometry.x, agent.geometry.y): agent.status for agent in model.agents_by_type[Resident]}
+    assert statuses[(stranded.x, stranded.y)] == "stranded"
@@ -1,5 +1,6 @@
 from mesa_geo import GeoAgent
 import math
+import numpy as np
 class GMModel:
 
     def __init__(self, model, car_ahead: GeoAgent, car_follow: GeoAgent):
@@ -75,4 +76,45 @@ class GMModelLegacy:
             
             updated_speed= min(updated_speed, self.max_speed)  # Cap to max speed
 
-        return updated_speed
\ No newline at end of file
+        return updated_speed
+
+class GMModelVectorized:
+    """The GMModelLegacy update applied to arrays of follower/leader states at once."""
+
+    def __init__(self, model):
+        self.space_headway_threshold = 6 # Space headway threshold in feet
+        self.max_speed = model.max_speed
+        self.acceleration = model.acceleration
+        self.alpha = model.alpha
+        self.step_interval = model.step_interval
+
+    def update_speed(self, speed, leader_speed, space_hw, has_leader):
+        """
+        Compute the updated speeds of the following cars.
+        :param speed: The current speeds of the following cars.
+        :type speed: np.ndarray
+        :param leader_speed: The current speeds of the cars ahead (ignored where `has_leader` is False).
+        :type leader_speed: np.ndarray
+        :param space_hw: The space headways to the cars ahead (ignored where `has_leader` is False).
+        :type space_hw: np.ndarray
+        :param has_leader: Whether each following car has a car ahead.
+        :type has_leader: np.ndarray
+        :return: The updated speeds.
+        :rtype: np.ndarray
+        """
+
+        threshold = self.space_headway_threshold
+        with np.errstate(divide="ignore", invalid="ignore"):
+            # Following a car ahead
+            speed_diff = speed - leader_speed
+            acc = (self.alpha * 719.44) * (speed ** 2) / (space_hw ** 2) * speed_diff
+            following = np.where(space_hw < threshold, 0.0, speed + acc * self.step_interval)
+            gap_speed = (space_hw - threshold) / self.step_interval
+            following = np.where(speed > gap_speed, np.minimum(gap_speed, leader_speed), following)
+            following = np.maximum(np.minimum(following, self.max_speed), 0)
+
+        # Free flow
+        free = np.where(speed < self.max_speed, speed + self.acceleration * self.step_interval, speed)
+        free = np.minimum(free, self.max_speed)
+
+        return np.where(has_leader, following, free)